@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+顔認識パイプラインのオフライン計測
+
+撮影済みの画像（~/captures や ~/detections の detection_*_original.jpg）または動画を、
+watch_faces.py と同じ FrameAnalyzer（ROI切り出し・縮小・検出・エンコード・照合）に通し、
+face_model / upsample / 検出幅（resize_width または encode_full_res 時の detect_width）/ ROI の
+組み合わせごとに次を出力する。
+
+- fps（推論のみ。画像の読み込みは含まない）
+- 処理段階ごとの所要時間 p50/p95/p99
+- ピークRSS（組み合わせごとに別プロセスで計測）
+- 基準ラベルとの一致率
+
+基準ラベルは --labels の JSON（{"ファイル名": ["名前", ...]}）、
+なければ detection_*_meta.json の検出結果、それもなければ最初の組み合わせの結果を使う。
+
+config.json のそのほかの設定はそのまま使う。検出に効く設定は組み合わせごとに固定し、
+実際に使った値を結果（--json の "applied"）に残す。
+
+例:
+    python benchmark_replay.py ~/detections --models hog,cnn,cascade --upsample 0,1 \\
+        --resize-width 320,640 --roi none,1 --limit 100 --json result.json
+    python benchmark_replay.py ~/detections --encode-full-res off,on --detect-width 240,320
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import itertools
+import subprocess
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+# 結果に残す、検出に効く設定
+APPLIED_KEYS = ("face_model", "upsample", "resize_width", "encode_full_res", "detect_width",
+                "use_roi", "roi_index", "motion_gate", "tracker",
+                "cascade_prefilter", "cascade_padding", "cascade_prefilter_width")
+
+def list_images(directory):
+    """計測に使う画像一覧。detection_*_original.jpg があればそれだけを使う"""
+    originals = sorted(glob.glob(os.path.join(directory, "detection_*_original.jpg")))
+    if originals:
+        return originals
+    return sorted(p for p in glob.glob(os.path.join(directory, "*"))
+                  if p.lower().endswith(IMAGE_EXTS) and not os.path.basename(p).startswith("latest_frame"))
+
+def iter_frames(source, limit=None, step=1):
+    """(キー, BGRフレーム) を返す。source はディレクトリか動画ファイル"""
+    import cv2
+    count = 0
+    if os.path.isdir(source):
+        for path in list_images(source)[::step]:
+            if limit and count >= limit:
+                return
+            frame = cv2.imread(path)
+            if frame is None:
+                continue
+            count += 1
+            yield os.path.basename(path), frame
+        return
+
+    cap = cv2.VideoCapture(source)
+    index = 0
+    try:
+        while not limit or count < limit:
+            ret, frame = cap.read()
+            if not ret:
+                return
+            if index % step == 0:
+                count += 1
+                yield f"frame_{index:06d}", frame
+            index += 1
+    finally:
+        cap.release()
+
+def load_meta_labels(source):
+    """detection_*_meta.json の検出名を {画像ファイル名: [名前]} にする"""
+    labels = {}
+    if not os.path.isdir(source):
+        return labels
+    for path in glob.glob(os.path.join(source, "detection_*_meta.json")):
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        image = os.path.basename(path).replace("_meta.json", "_original.jpg")
+        labels[image] = sorted({face["name"] for face in meta.get("faces", [])})
+    return labels
+
+def run_one(spec):
+    """1つの組み合わせを計測する（子プロセスで実行）"""
+    import watch_faces
+
+    config = watch_faces.load_config()
+    config.update(spec["config"])
+    names, encodings = watch_faces.read_encodings(os.path.expanduser(config["encodings_path"]))
+    matcher = watch_faces.FaceMatcher(names, encodings)
+    analyzer = watch_faces.FrameAnalyzer(config, matcher)
+
+    frames = 0
+    elapsed = 0.0
+    results = {}
+    for i, (key, frame) in enumerate(iter_frames(spec["source"], spec["limit"], spec["step"])):
+        if i == spec["warmup"]:
+            # モデルの初回ロードを計測から外す
+            analyzer.timer = watch_faces.StageTimer(window=spec["limit"] or 100000)
+        started = time.monotonic()
+        result = analyzer.analyze(frame)
+        if i >= spec["warmup"]:
+            frame_elapsed = time.monotonic() - started
+            analyzer.timer.record("analyze", frame_elapsed * 1000)  # watch_faces.main() と同じ段階名
+            elapsed += frame_elapsed
+            frames += 1
+        results[key] = sorted(result["names"])
+
+    return {
+        "config": spec["config"],
+        "applied": {key: config.get(key) for key in APPLIED_KEYS},
+        "frames": frames,
+        "fps": round(frames / elapsed, 2) if elapsed else None,
+        "stages": analyzer.timer.snapshot(),
+        "rss_peak_mb": watch_faces.read_system_stats()["rss_peak_mb"],
+        "names": results,
+    }
+
+def agreement(names, baseline):
+    """基準と名前の集合が一致したフレームの割合と、名前単位の適合率・再現率"""
+    keys = [k for k in names if k in baseline]
+    if not keys:
+        return {"frames": 0, "exact": None, "precision": None, "recall": None}
+    exact = sum(set(names[k]) == set(baseline[k]) for k in keys)
+    tp = sum(len(set(names[k]) & set(baseline[k])) for k in keys)
+    predicted = sum(len(names[k]) for k in keys)
+    expected = sum(len(baseline[k]) for k in keys)
+    return {
+        "frames": len(keys),
+        "exact": round(exact / len(keys), 3),
+        "precision": round(tp / predicted, 3) if predicted else None,
+        "recall": round(tp / expected, 3) if expected else None,
+    }
+
+def parse_list(value, cast=str):
+    return [cast(v) for v in value.split(",") if v != ""]
+
+def parse_switch(value):
+    return value in ("on", "true", "1")
+
+def detect_width_of(config):
+    """検出に使う縮小幅（encode_full_res では detect_width）"""
+    return config["detect_width"] if config["encode_full_res"] else config["resize_width"]
+
+def build_specs(args):
+    resize_widths = parse_list(args.resize_width, int)
+    detect_widths = parse_list(args.detect_width, int)
+    # (encode_full_res, resize_width, detect_width)。効かない方の幅は最初の値に固定し、
+    # config.json の値が紛れ込まないように必ず両方指定する
+    widths = []
+    for full_res in [parse_switch(v) for v in parse_list(args.encode_full_res)]:
+        if full_res:
+            widths += [(True, resize_widths[0], w) for w in detect_widths]
+        else:
+            widths += [(False, w, detect_widths[0]) for w in resize_widths]
+    specs = []
+    for model, upsample, (full_res, resize_width, detect_width), roi in itertools.product(
+            parse_list(args.models), parse_list(args.upsample, int), widths, parse_list(args.roi)):
+        config = {
+            "face_model": model,
+            "upsample": upsample,
+            "resize_width": resize_width,
+            "encode_full_res": full_res,
+            "detect_width": detect_width,
+            # 計測ではフレームごとの処理量をそろえる（--live で稼働時と同じ設定にできる）
+            "motion_gate": args.live,
+            "tracker": args.live,
+        }
+        if roi == "none":
+            config["use_roi"] = False
+        else:
+            config.update({"use_roi": True, "roi_index": roi})
+        specs.append({"source": args.source, "limit": args.limit, "step": args.step,
+                      "warmup": args.warmup, "config": config})
+    return specs
+
+def format_ms(stage):
+    if not stage:
+        return "-"
+    return f"{stage['p50']:.1f}/{stage['p95']:.1f}/{stage['p99']:.1f}"
+
+def print_table(results):
+    print()
+    print("| model | upsample | 検出幅 | full res | ROI | fps | face_locations (ms) | face_encodings (ms) "
+          "| analyze (ms) | peak RSS (MB) | 一致率 | 適合率 | 再現率 |")
+    print("|---|---|---|---|---|---|---|---|---|---|---|---|---|")
+    for r in results:
+        c = r["config"]
+        if "error" in r:
+            print(f"| {c['face_model']} | {c['upsample']} | {detect_width_of(c)} | {'on' if c['encode_full_res'] else 'off'} "
+                  f"| {c.get('roi_index', 'なし')} | エラー: {r['error']} |||||||")
+            continue
+        a = r["agreement"]
+        print(f"| {c['face_model']} | {c['upsample']} | {detect_width_of(c)} | {'on' if c['encode_full_res'] else 'off'} "
+              f"| {c.get('roi_index', 'なし')} | {r['fps']} | {format_ms(r['stages'].get('face_locations'))} "
+              f"| {format_ms(r['stages'].get('face_encodings'))} | {format_ms(r['stages'].get('analyze'))} "
+              f"| {r['rss_peak_mb']} | {a['exact']} | {a['precision']} | {a['recall']} |")
+    print()
+    print("ms は p50/p95/p99。analyze は ROI〜照合の合計。検出幅は full res 時は detect_width、それ以外は resize_width。")
+
+def main():
+    parser = argparse.ArgumentParser(description="顔認識パイプラインのオフライン計測")
+    parser.add_argument("source", nargs="?", default=os.path.expanduser("~/captures"),
+                        help="画像ディレクトリまたは動画ファイル（既定: ~/captures）")
+    parser.add_argument("--models", default="hog", help="face_model（カンマ区切り: hog,cnn,cascade）")
+    parser.add_argument("--upsample", default="0", help="upsample（カンマ区切り）")
+    parser.add_argument("--resize-width", default="640", help="resize_width（カンマ区切り、0で縮小なし）")
+    parser.add_argument("--encode-full-res", default="off",
+                        help="encode_full_res（off,on のカンマ区切り。config.json の値は使わない）")
+    parser.add_argument("--detect-width", default="320", help="encode_full_res 時の detect_width（カンマ区切り）")
+    parser.add_argument("--roi", default="none", help="ROIプリセット番号（1から、カンマ区切り。none でROIなし）")
+    parser.add_argument("--limit", type=int, default=None, help="使うフレーム数の上限")
+    parser.add_argument("--step", type=int, default=1, help="N枚ごとに1枚使う")
+    parser.add_argument("--warmup", type=int, default=1, help="計測から外す先頭フレーム数")
+    parser.add_argument("--live", action="store_true", help="動き検出ゲートとトラッカーを有効にする")
+    parser.add_argument("--labels", help="基準ラベルの JSON（{ファイル名: [名前]}）")
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    if args.labels:
+        with open(args.labels) as f:
+            baseline = json.load(f)
+        baseline_source = args.labels
+    else:
+        baseline = load_meta_labels(args.source)
+        baseline_source = "detection_*_meta.json" if baseline else None
+
+    results = []
+    for spec in build_specs(args):
+        c = spec["config"]
+        print(f"計測中: model={c['face_model']} upsample={c['upsample']} 検出幅={detect_width_of(c)} "
+              f"full_res={'on' if c['encode_full_res'] else 'off'} "
+              f"ROI={c.get('roi_index', 'なし')}", file=sys.stderr)
+        # ピークRSSを組み合わせごとに測るため別プロセスで実行する
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", json.dumps(spec)],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            error = (proc.stderr.strip().splitlines() or ["不明なエラー"])[-1]
+            print(f"  失敗: {error}", file=sys.stderr)
+            results.append({"config": c, "error": error})
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        if not baseline:
+            # 基準ラベルがなければ最初の組み合わせの結果を基準にする
+            baseline = result["names"]
+            baseline_source = "最初の組み合わせ"
+        result["agreement"] = agreement(result["names"], baseline)
+        results.append(result)
+
+    print_table(results)
+    if baseline_source:
+        print(f"一致率の基準: {baseline_source}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"source": args.source, "baseline": baseline_source, "results": results}, f, indent=2)
+        print("書き出し完了:", args.json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+カメラブローカー
+
+カメラデバイスを1つのプロセスだけで開き、最新フレームを共有メモリ（frame_channel）に
+書き出す。顔認識サービスと Web UI のプレビュー・撮影はここからフレームを受け取るので、
+プレビューを開いても顔認識サービスを止める必要がない。
+各利用側は自分の間隔で読み、解像度や JPEG 画質も自分で決める。
+
+使い方:
+    python camera_broker.py
+    （config.json の "camera_source" を "broker" にすると顔認識サービスがこれを使う）
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+
+import cv2
+
+from frame_channel import FrameChannelWriter, FrameChannelReader
+
+# ロギング設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.expanduser("~/config.json")
+DEFAULT_CHANNEL_PATH = "/dev/shm/tv_watch_camera"
+
+def load_config():
+    """設定ファイルを読み込む。なければデフォルト値を返す"""
+    defaults = {
+        "camera_device": 0,
+        "camera_retry_sec": 5,
+        "max_camera_retries": 10,
+        "camera_channel_path": DEFAULT_CHANNEL_PATH,
+        "broker_fps": 10,  # 共有メモリに書き出す上限フレームレート
+    }
+    if os.path.exists(CONFIG_PATH):
+        try:
+            with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+                defaults.update(json.load(f))
+        except json.JSONDecodeError as e:
+            logger.error("設定ファイルのJSON解析エラー: %s", e)
+    return defaults
+
+def channel_path(config):
+    return os.path.expanduser(config.get("camera_channel_path") or DEFAULT_CHANNEL_PATH)
+
+class CameraSource:
+    """カメラを専用スレッドで読み続け、常に最新のフレームだけを保持する
+
+    V4L2 のバッファに古いフレームが溜まらないよう grab() で常にドレインし、
+    デコード（retrieve）は推論側から要求があったときだけ行う。
+    フレームはコピーせずにスロットへ置くため、受け取った側は書き換えないこと。
+    再接続もこのスレッド内で行い、推論ループはブロックされない。
+    """
+
+    def __init__(self, device, retry_sec=5, max_retries=10, max_consecutive_failures=30):
+        self.device = device
+        self.retry_sec = retry_sec
+        self.max_retries = max_retries
+        self.max_consecutive_failures = max_consecutive_failures
+
+        self._cond = threading.Condition()
+        self._frame = None
+        self._frame_time = 0.0
+        self._seq = 0
+        self._last_read_seq = 0
+        self._wanted = False
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.failed = False
+        self.connected = False
+        self.grabbed = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.grab_fps = 0.0
+        self.last_frame_age_ms = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="camera", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _open(self):
+        """カメラを開く。失敗時はリトライし、上限に達したらNone"""
+        for attempt in range(self.max_retries):
+            if self._stop.is_set():
+                return None
+            cap = cv2.VideoCapture(self.device)
+            if cap.isOpened():
+                cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+                logger.info("カメラを開きました: device=%s", self.device)
+                return cap
+
+            logger.warning(
+                "カメラを開けません (試行 %d/%d)。%d秒後にリトライ...",
+                attempt + 1, self.max_retries, self.retry_sec
+            )
+            self._stop.wait(self.retry_sec)
+        return None
+
+    def _run(self):
+        cap = self._open()
+        if cap is None:
+            logger.error("カメラを開けませんでした。")
+            self.failed = True
+            return
+        self.connected = True
+
+        consecutive_failures = 0
+        window_start = time.monotonic()
+        window_grabs = 0
+
+        try:
+            while not self._stop.is_set():
+                if not cap.grab():
+                    consecutive_failures += 1
+                    if consecutive_failures % 10 == 1:
+                        logger.warning("フレーム取得失敗 (%d/%d)",
+                                       consecutive_failures, self.max_consecutive_failures)
+
+                    if consecutive_failures >= self.max_consecutive_failures:
+                        logger.error("連続失敗が上限に達しました。カメラを再接続します...")
+                        self.connected = False
+                        cap.release()
+                        self._stop.wait(self.retry_sec)
+                        cap = self._open()
+                        if cap is None:
+                            logger.error("カメラを再接続できませんでした。")
+                            self.failed = True
+                            return
+                        self.connected = True
+                        self.reconnects += 1
+                        consecutive_failures = 0
+                    else:
+                        self._stop.wait(0.1)
+                    continue
+
+                consecutive_failures = 0
+                self.grabbed += 1
+                window_grabs += 1
+                now = time.monotonic()
+                if now - window_start >= 2.0:
+                    self.grab_fps = window_grabs / (now - window_start)
+                    window_start = now
+                    window_grabs = 0
+
+                # 要求があるときだけデコードしてスロットに置く
+                if self._wanted:
+                    ret, frame = cap.retrieve()
+                    if ret:
+                        with self._cond:
+                            self._frame = frame
+                            self._frame_time = now
+                            self._seq = self.grabbed
+                            self._wanted = False
+                            self._cond.notify_all()
+        finally:
+            cap.release()
+            self.connected = False
+            logger.info("カメラを解放しました")
+
+    def read(self, timeout=None):
+        """最新フレームを待って返す。(frame, 取得時刻) またはタイムアウト時 None"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._wanted = True
+            while self._seq <= self._last_read_seq:
+                if self._stop.is_set() or self.failed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(0.5 if remaining is None else min(remaining, 0.5))
+            if self._last_read_seq:
+                self.dropped += self._seq - self._last_read_seq - 1
+            self._last_read_seq = self._seq
+            self.last_frame_age_ms = round((time.monotonic() - self._frame_time) * 1000, 1)
+            return self._frame, self._frame_time
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "grab_fps": round(self.grab_fps, 1),
+            "grabbed": self.grabbed,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+            "frame_age_ms": self.last_frame_age_ms,
+        }
+
+class BrokerSource:
+    """カメラブローカーの共有メモリからフレームを受け取る（CameraSource と同じ使い方）
+
+    共有メモリのスロットはブローカーが次々に上書きするので、read() はコピーを返す。
+    ブローカーが止まっている間は read() が None を返し続け、再開すれば自然に復帰する。
+    """
+
+    def __init__(self, path, stale_sec=5):
+        self.path = path
+        self.stale_sec = stale_sec
+        self._reader = FrameChannelReader(path)
+        self._stop = threading.Event()
+        self._started = False
+        self._last_seq = 0
+        self._last_warned = 0.0
+
+        self.failed = False
+        self.connected = False
+        self.grabbed = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.grab_fps = 0.0
+        self.last_frame_age_ms = None
+
+    def start(self):
+        self._started = True
+        logger.info("カメラブローカーからフレームを受け取ります: %s", self.path)
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+
+    def is_alive(self):
+        return self._started and not self._stop.is_set()
+
+    def _latest(self):
+        latest = self._reader.latest()
+        if latest is None or time.time() - latest.captured_at > self.stale_sec:
+            return None
+        return latest
+
+    def read(self, timeout=None):
+        """新しいフレームを待って返す。(frame, 取得時刻) またはタイムアウト時 None"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._stop.is_set():
+            latest = self._latest()
+            if latest is not None and latest.seq != self._last_seq:
+                frame = latest.frame.copy()
+                if FrameChannelReader.is_current(latest):
+                    if self._last_seq and latest.seq > self._last_seq:
+                        self.dropped += latest.seq - self._last_seq - 1
+                    self._last_seq = latest.seq
+                    self.connected = True
+                    self.grabbed += 1
+                    self.grab_fps = latest.meta.get("camera", {}).get("grab_fps", 0.0)
+                    age = max(0.0, time.time() - latest.captured_at)
+                    self.last_frame_age_ms = round(age * 1000, 1)
+                    # 取得時刻は CameraSource と同じく monotonic 基準にそろえる
+                    return frame, time.monotonic() - age
+                continue
+            if latest is None:
+                self.connected = False
+                now = time.monotonic()
+                if now - self._last_warned >= 60:
+                    logger.warning("カメラブローカーからフレームが届きません: %s", self.path)
+                    self._last_warned = now
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            self._stop.wait(0.01)
+        return None
+
+    def stats(self):
+        return {
+            "source": "broker",
+            "connected": self.connected,
+            "grab_fps": round(self.grab_fps, 1),
+            "grabbed": self.grabbed,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+            "frame_age_ms": self.last_frame_age_ms,
+        }
+
+def handle_sigterm(signum, frame):
+    # systemctl stop でも KeyboardInterrupt と同じ終了処理を通す
+    raise KeyboardInterrupt
+
+def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    config = load_config()
+    path = channel_path(config)
+    interval = 1.0 / max(0.1, float(config.get("broker_fps", 10)))
+
+    camera = CameraSource(
+        config["camera_device"],
+        retry_sec=config.get("camera_retry_sec", 5),
+        max_retries=config.get("max_camera_retries", 10),
+    ).start()
+    writer = FrameChannelWriter(path, slots=4)
+    logger.info("カメラブローカーを開始します: %s (%.1ffps)", path, 1.0 / interval)
+
+    try:
+        while True:
+            started = time.monotonic()
+            item = camera.read(timeout=1)
+            if item is None:
+                if camera.failed or not camera.is_alive():
+                    logger.error("カメラを開けませんでした。終了します。")
+                    sys.exit(1)
+                continue
+            frame, captured_at = item
+            writer.publish(frame, {"camera": camera.stats()},
+                           captured_at=time.time() - (time.monotonic() - captured_at))
+            remaining = interval - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+    except KeyboardInterrupt:
+        logger.info("停止要求を受けました")
+    finally:
+        camera.stop()
+        # 共有メモリを消して、利用側にブローカーの停止を知らせる
+        writer.close(unlink=True)
+        logger.info("終了します。")
+
+if __name__ == "__main__":
+    main()
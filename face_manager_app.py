@@ -14,10 +14,13 @@ import json
 import time
 import glob
 import shutil
+import threading
 import cv2
 import face_recognition
 import pickle
 from flask import Flask, render_template_string, jsonify, request, Response, send_file
+from frame_channel import FrameChannelReader, default_path as frame_channel_path
+from camera_broker import channel_path as camera_channel_path
 
 app = Flask(__name__)
 
@@ -32,6 +35,8 @@ os.makedirs(CAPTURES_DIR, exist_ok=True)
 os.makedirs(FACES_DIR, exist_ok=True)
 
 camera = None
+camera_lock = threading.Lock()  # camera.read() は /stream の配信スレッドと /capture で共有
+channel_readers = {}
 
 def load_config():
     if os.path.exists(CONFIG_PATH):
@@ -43,6 +48,32 @@ def save_config(config):
     with open(CONFIG_PATH, "w") as f:
         json.dump(config, f, indent=2)
 
+def save_encodings(data):
+    """エンコーディングを一時ファイル経由で置き換える（稼働中のサービスが途中状態を読まないように）"""
+    tmp_path = ENCODINGS_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(data, f)
+    os.replace(tmp_path, ENCODINGS_PATH)
+
+def send_tracker_command(cmd, timeout=30):
+    """稼働中のトラッカーの制御ソケットに要求を送り、応答を返す（使えなければNone）"""
+    import socket
+    path = load_config().get("control_socket", "~/.tv_watch_tracker.sock")
+    if not path:
+        return None
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall((json.dumps({"cmd": cmd}) + "\n").encode("utf-8"))
+            line = sock.makefile("r", encoding="utf-8").readline()
+        return json.loads(line)
+    except (OSError, ValueError):
+        return None
+
 def is_service_running():
     """顔認識サービスが稼働中かチェック"""
     import subprocess
@@ -57,15 +88,17 @@ def is_service_running():
 
 def get_camera():
     global camera
-    if camera is None or not camera.isOpened():
-        camera = cv2.VideoCapture(0)
-    return camera
+    with camera_lock:
+        if camera is None or not camera.isOpened():
+            camera = cv2.VideoCapture(0)
+        return camera
 
 def release_camera():
     global camera
-    if camera is not None:
-        camera.release()
-        camera = None
+    with camera_lock:
+        if camera is not None:
+            camera.release()
+            camera = None
 
 def stop_service_and_get_camera():
     """顔認識サービスを停止してカメラを取得"""
@@ -90,6 +123,55 @@ def get_roi_by_index(roi_index):
         pass
     return None
 
+def read_channel_frame(path, max_age_sec=None):
+    """共有メモリ（frame_channel）の最新フレームを返す（なければNone）"""
+    if not path:
+        return None
+    reader = channel_readers.get(path)
+    if reader is None:
+        reader = channel_readers[path] = FrameChannelReader(path)
+    latest = reader.latest()
+    if latest is None:
+        return None
+    if max_age_sec is not None and time.time() - latest.captured_at > max_age_sec:
+        return None
+    return latest
+
+def read_service_frame(max_age_sec=None):
+    """トラッカーが共有メモリに書いた最新フレームを返す（なければNone）"""
+    return read_channel_frame(frame_channel_path(load_config()), max_age_sec)
+
+def read_broker_frame(max_age_sec=5):
+    """カメラブローカーが共有メモリに書いた最新フレームを返す（動いていなければNone）"""
+    return read_channel_frame(camera_channel_path(load_config()), max_age_sec)
+
+def encode_channel_frame(latest, draw=None, quality=None):
+    """共有メモリのフレームをJPEGにする（draw があればコピーに描画してから）
+
+    エンコード中に書き手がスロットを上書きした場合は None を返す。
+    """
+    img = latest.frame
+    if draw is not None:
+        img = img.copy()
+        draw(img)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality else []
+    ok, jpeg = cv2.imencode('.jpg', img, params)
+    if not ok or not FrameChannelReader.is_current(latest):
+        return None
+    return jpeg.tobytes()
+
+def draw_service_overlays(img, meta):
+    """トラッカーと同じROI枠とBBoxを描画する（座標はフルフレーム基準）"""
+    roi = meta.get("roi")
+    if roi:
+        cv2.rectangle(img, (roi["x"], roi["y"]), (roi["x"] + roi["w"], roi["y"] + roi["h"]), (0, 165, 255), 2)
+    for face in meta.get("faces", []):
+        bbox = face["bbox"]
+        color = (0, 255, 0) if face["name"] != "unknown" else (0, 0, 255)
+        cv2.rectangle(img, (bbox["left"], bbox["top"]), (bbox["right"], bbox["bottom"]), color, 2)
+        cv2.putText(img, f"{face['name']} ({face['similarity']:.0f}%)", (bbox["left"], bbox["top"] - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="ja">
@@ -558,6 +640,10 @@ HTML_TEMPLATE = """
                     <h4 style="margin:0 0 10px 0;color:#4ecdc4;">適用中の設定</h4>
                     <div id="appliedConfigDisplay" style="font-size:0.9em;color:#ccc;">読込中...</div>
                 </div>
+                <div style="background:#0f3460;padding:15px;border-radius:8px;margin-bottom:20px;">
+                    <h4 style="margin:0 0 10px 0;color:#4ecdc4;">処理時間・リソース</h4>
+                    <div id="metricsDisplay" style="font-size:0.9em;color:#ccc;">読込中...</div>
+                </div>
             </div>
             <div class="card">
                 <h2>設定変更</h2>
@@ -567,6 +653,7 @@ HTML_TEMPLATE = """
                         <select id="cfgModel">
                             <option value="hog">HOG（高速）</option>
                             <option value="cnn">CNN（高精度）</option>
+                            <option value="cascade">カスケード（候補領域のみCNN・省メモリ）</option>
                         </select>
                     </div>
                     <div class="form-group">
@@ -721,7 +808,8 @@ HTML_TEMPLATE = """
                 const serviceContainer = document.getElementById('serviceImageContainer');
                 const cameraContainer = document.getElementById('cameraContainer');
                 const title = document.getElementById('cameraTitle');
-                if (data.service_running) {
+                // カメラブローカーが動いていればサービス稼働中でもプレビューできる
+                if (data.service_running && !data.broker) {
                     serviceContainer.style.display = 'block';
                     cameraContainer.style.display = 'none';
                     title.textContent = '検出画像';
@@ -2100,9 +2188,65 @@ HTML_TEMPLATE = """
             const tolerance = cfg.tolerance || 0.5;
             const similarity = Math.round((1 - tolerance) * 100);
             const roiText = cfg.roi_index ? `ROI ${cfg.roi_index}` : 'なし';
-            return `検出モデル: ${cfg.face_model || 'hog'}<br>UpSample: ${cfg.upsample || 0}<br>撮影間隔: ${intervalText}<br>類似度閾値: ${similarity}%<br>ROI: ${roiText}`;
+            let text = `検出モデル: ${cfg.face_model || 'hog'}<br>UpSample: ${cfg.upsample || 0}<br>撮影間隔: ${intervalText}<br>類似度閾値: ${similarity}%<br>ROI: ${roiText}`;
+            if (cfg.sampling && cfg.sampling.effective_interval_sec) {
+                text += `<br>実効間隔: ${cfg.sampling.effective_interval_sec}秒（現在 ${cfg.sampling.interval_sec}秒）`;
+            }
+            const guard = cfg.memory_guard;
+            if (guard && guard.level > 0 && guard.settings) {
+                const st = guard.settings;
+                const width = st.resize_width != null ? st.resize_width : st.detect_width;
+                text += `<br><span style="color:#e67e22;">メモリ制限 ${guard.budget_mb}MB により軽量化中: ` +
+                    `${st.face_model} / UpSample ${st.upsample} / 縮小幅 ${width}</span>`;
+            }
+            return text;
+        }
+
+        const STAGE_LABELS = {
+            capture_wait: 'カメラ待ち', motion_gate: '動き検出', resize: '縮小', cvt_color: '色変換',
+            face_locations: '顔検出', tracker: 'トラッカー', face_encodings: 'エンコード', match: '照合',
+            analyze: '推論合計', frame: '撮影→推論完了', log_write: 'ログ書込', jpeg_encode: 'JPEG変換',
+            file_write: 'ファイル書込', frame_channel: '共有メモリ', retention: '古い画像削除', persist: '保存合計'
+        };
+
+        function formatMetricsDisplay(m) {
+            const sys = m.system || {};
+            const parts = [];
+            if (sys.rss_mb != null) parts.push(`メモリ: ${sys.rss_mb}MB（最大 ${sys.rss_peak_mb}MB）`);
+            if (sys.cpu_temp_c != null) parts.push(`CPU温度: ${sys.cpu_temp_c}℃`);
+            if (sys.throttled != null) {
+                const flags = (sys.throttled_flags || []).join(', ');
+                parts.push(`スロットリング: ${sys.throttled}${flags ? `（${flags}）` : ''}`);
+            }
+            let text = parts.join('<br>');
+            const rows = Object.entries(m.stages || {}).map(([stage, st]) =>
+                `<tr><td style="padding:2px 8px 2px 0;">${STAGE_LABELS[stage] || stage}</td>` +
+                `<td style="text-align:right;padding:2px 6px;">${st.p50}</td>` +
+                `<td style="text-align:right;padding:2px 6px;">${st.p95}</td>` +
+                `<td style="text-align:right;padding:2px 6px;">${st.p99}</td>` +
+                `<td style="text-align:right;padding:2px 6px;color:#888;">${st.count}</td></tr>`).join('');
+            if (rows) {
+                text += `<table style="margin-top:10px;border-collapse:collapse;">` +
+                    `<tr style="color:#888;"><th style="text-align:left;">段階 (ms)</th><th>p50</th><th>p95</th><th>p99</th><th>件数</th></tr>` +
+                    rows + `</table>`;
+            }
+            return text || '<span style="color:#888;">データなし</span>';
+        }
+
+        function loadMetrics() {
+            fetch('/api/metrics').then(r => r.json()).then(data => {
+                const el = document.getElementById('metricsDisplay');
+                if (data.running && data.metrics) {
+                    el.innerHTML = formatMetricsDisplay(data.metrics);
+                } else {
+                    el.innerHTML = '<span style="color:#888;">サービス停止中</span>';
+                }
+            });
         }
 
+        // 顔認識タブ表示中は処理時間を10秒ごとに更新
+        setInterval(() => { if (currentTab === 'settings') loadMetrics(); }, 10000);
+
         function updateCfgServiceStatus(running) {
             const el = document.getElementById('cfgServiceStatus');
             if (el) {
@@ -2140,10 +2284,11 @@ HTML_TEMPLATE = """
                     document.getElementById('appliedConfigDisplay').innerHTML = '<span style="color:#888;">サービス停止中</span>';
                 }
             });
+            loadMetrics();
         }
 
         function saveAndApplyConfig() {
-            if (!confirm('設定を保存してサービスを再起動しますか？')) return;
+            if (!confirm('設定を保存してサービスに反映しますか？')) return;
             const st = document.getElementById('configStatus');
             const similarityThreshold = parseFloat(document.getElementById('cfgTolerance').value);
             const tolerance = 1 - similarityThreshold / 100;
@@ -2168,6 +2313,15 @@ HTML_TEMPLATE = """
                     st.style.color = '#ff6b6b';
                     return null;
                 }
+                if (data.live) {
+                    // 稼働中のサービスが再起動なしで反映済み
+                    st.textContent = '設定を反映しました';
+                    st.style.color = '#4ecdc4';
+                    document.getElementById('appliedConfigDisplay').innerHTML = formatConfigDisplay(data.applied);
+                    updateCfgServiceStatus(true);
+                    setTimeout(() => st.textContent = '', 3000);
+                    return null;
+                }
                 st.textContent = '再起動中...';
                 return fetch('/api/service_control', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({action: 'restart'}) });
             })
@@ -2223,6 +2377,9 @@ def manual():
 
 @app.route("/start_camera", methods=["POST"])
 def start_camera():
+    if read_broker_frame() is not None:
+        # カメラブローカー経由ならサービスを止めずにプレビューできる
+        return jsonify({"success": True})
     if is_service_running():
         os.system("sudo systemctl stop tv-watch-tracker 2>/dev/null")
         time.sleep(0.5)
@@ -2231,42 +2388,186 @@ def start_camera():
 
 @app.route("/camera_status")
 def camera_status():
-    return jsonify({"service_running": is_service_running(), "camera_available": camera is not None and camera.isOpened()})
-
-def gen_frames():
-    global camera
-    while True:
-        if camera is None or not camera.isOpened():
-            placeholder = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde\x00\x00\x00\x0cIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82'
-            yield (b'--frame\r\nContent-Type: image/png\r\n\r\n' + placeholder + b'\r\n')
-            time.sleep(1)
-            continue
-        ret, frame = camera.read()
+    broker = read_broker_frame() is not None
+    return jsonify({"service_running": is_service_running(), "broker": broker,
+                    "camera_available": broker or (camera is not None and camera.isOpened())})
+
+STREAM_PLACEHOLDER = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde\x00\x00\x00\x0cIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82'
+
+class MjpegHub:
+    """/stream の配信元: 1つのスレッドがフレームを読み、(画質, 幅) ごとに1回だけエンコードする
+
+    各クライアントは購読して共有の最新JPEGを受け取り、自分のfpsで間引いて送る。
+    購読者がいなくなるとスレッドは終了し、カメラもエンコードも使わない。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._subscribers = {}  # id(sub) -> {"key": (quality, width), "fps": fps}
+        self._slots = {}  # (quality, width) -> (seq, jpeg)
+        self._thread = None
+        self.seq = 0
+        self.encodes = 0
+
+    def subscribe(self, quality=80, width=None, fps=10):
+        sub = {"key": (quality, width), "fps": fps}
+        with self._cond:
+            self._subscribers[id(sub)] = sub
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mjpeg", daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._cond:
+            self._subscribers.pop(id(sub), None)
+            keys = {s["key"] for s in self._subscribers.values()}
+            for key in list(self._slots):
+                if key not in keys:
+                    del self._slots[key]
+
+    def wait_frame(self, sub, last_seq, timeout=1.0):
+        """last_seq より新しいJPEGを待って (seq, jpeg) を返す。タイムアウト時 None"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                slot = self._slots.get(sub["key"])
+                if slot is not None and slot[0] > last_seq:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def _encode(self, frame, keys):
+        """フレームを (画質, 幅) ごとにJPEGにする"""
+        jpegs = {}
+        for quality, width in keys:
+            img = frame
+            if width and width < frame.shape[1]:
+                height = int(frame.shape[0] * width / frame.shape[1])
+                img = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            ok, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                jpegs[(quality, width)] = jpeg.tobytes()
+                self.encodes += 1
+        return jpegs
+
+    def _next_frame(self, broker_path, last_seq):
+        """(seq, jpegs) を返す。新しいフレームがなければ None"""
+        with self._cond:
+            keys = {s["key"] for s in self._subscribers.values()}
+        latest = read_channel_frame(broker_path, max_age_sec=5)
+        if latest is not None:
+            # カメラブローカー経由（顔認識サービスと同時に使える）
+            if latest.seq == last_seq:
+                return None
+            jpegs = self._encode(latest.frame, keys)
+            if not FrameChannelReader.is_current(latest):
+                return None
+            return latest.seq, jpegs
+        with camera_lock:
+            if camera is None or not camera.isOpened():
+                return None
+            ret, frame = camera.read()
         if not ret:
-            time.sleep(0.1)
-            continue
-        _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-        yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+            return None
+        return last_seq + 1, self._encode(frame, keys)
+
+    def _run(self):
+        broker_path = camera_channel_path(load_config())
+        source_seq = 0
+        while True:
+            with self._cond:
+                if not self._subscribers:
+                    self._thread = None
+                    self._slots.clear()
+                    return
+                max_fps = max(s["fps"] for s in self._subscribers.values())
+            started = time.monotonic()
+            result = self._next_frame(broker_path, source_seq)
+            if result is None:
+                time.sleep(0.05)
+                continue
+            source_seq, jpegs = result
+            with self._cond:
+                self.seq += 1
+                for key, jpeg in jpegs.items():
+                    self._slots[key] = (self.seq, jpeg)
+                self._cond.notify_all()
+            # 購読者のうち最も高いfpsを上限に読む
+            remaining = 1.0 / max_fps - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+
+mjpeg_hub = MjpegHub()
+
+def gen_frames(quality=80, width=None, fps=10):
+    sub = mjpeg_hub.subscribe(quality, width, fps)
+    try:
+        last_seq = 0
+        while True:
+            started = time.monotonic()
+            item = mjpeg_hub.wait_frame(sub, last_seq, timeout=1.0)
+            if item is None:
+                yield (b'--frame\r\nContent-Type: image/png\r\n\r\n' + STREAM_PLACEHOLDER + b'\r\n')
+                continue
+            last_seq, jpeg = item
+            yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+            remaining = 1.0 / fps - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+    finally:
+        mjpeg_hub.unsubscribe(sub)
 
 @app.route("/stream")
 def stream():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    """MJPEGストリーム（?fps=10&width=640&quality=80）"""
+    fps = min(max(request.args.get('fps', 10, type=float), 0.5), 30)
+    width = request.args.get('width', type=int)
+    width = min(max(width, 160), 1920) if width else None
+    quality = min(max(request.args.get('quality', 80, type=int), 10), 95)
+    return Response(gen_frames(quality, width, fps), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route("/capture", methods=["POST"])
 def capture():
+    filename = f"capture_{int(time.time())}.jpg"
+    for _ in range(2):
+        latest = read_broker_frame()
+        if latest is None:
+            break
+        jpeg = encode_channel_frame(latest, quality=95)
+        if jpeg is not None:
+            with open(os.path.join(CAPTURES_DIR, filename), "wb") as f:
+                f.write(jpeg)
+            return jsonify({"success": True, "filename": filename})
     if is_service_running():
         return jsonify({"success": False, "error": "顔認識サービス稼働中"})
     cam = get_camera()
-    ret, frame = cam.read()
+    with camera_lock:
+        ret, frame = cam.read()
     if not ret:
         return jsonify({"success": False, "error": "カメラエラー"})
-    filename = f"capture_{int(time.time())}.jpg"
     cv2.imwrite(os.path.join(CAPTURES_DIR, filename), frame)
     return jsonify({"success": True, "filename": filename})
 
 @app.route("/capture_service_frame", methods=["POST"])
 def capture_service_frame():
     """サービスの最新検出画像を撮影画像として保存（オーバーレイなし）"""
+    filename = f"capture_{int(time.time())}.jpg"
+    dst_path = os.path.join(CAPTURES_DIR, filename)
+
+    # 共有メモリのフレームを優先
+    for _ in range(2):
+        latest = read_service_frame()
+        if latest is None:
+            break
+        jpeg = encode_channel_frame(latest)
+        if jpeg is not None:
+            with open(dst_path, "wb") as f:
+                f.write(jpeg)
+            return jsonify({"success": True, "filename": filename})
+
     # クリーンなフレーム（オーバーレイなし）を優先
     clean_path = os.path.join(DETECTIONS_DIR, "latest_frame_clean.jpg")
     latest_path = os.path.join(DETECTIONS_DIR, "latest_frame.jpg")
@@ -2276,8 +2577,6 @@ def capture_service_frame():
         return jsonify({"success": False, "error": "最新画像がありません"})
 
     # 最新画像を撮影フォルダにコピー
-    filename = f"capture_{int(time.time())}.jpg"
-    dst_path = os.path.join(CAPTURES_DIR, filename)
     import shutil
     shutil.copy2(src_path, dst_path)
     return jsonify({"success": True, "filename": filename})
@@ -2570,8 +2869,7 @@ def build_encoding_for_label_internal(target_label):
     if encoded_files_list:
         new_files[target_label] = encoded_files_list
 
-    with open(ENCODINGS_PATH, "wb") as f:
-        pickle.dump({"names": new_names, "encodings": new_encodings, "files": new_files}, f)
+    save_encodings({"names": new_names, "encodings": new_encodings, "files": new_files})
 
 @app.route("/face_image/<filename>")
 def face_image(filename):
@@ -2914,10 +3212,11 @@ def recog_face(idx):
     return Response(jpeg.tobytes(), mimetype='image/jpeg')
 
 # ダッシュボードAPI
-import csv
 from datetime import datetime, timedelta
-from collections import defaultdict
 import subprocess
+from collections import deque
+from log_store import open_log_store
+from rollup_store import open_rollup_store
 
 LOG_PATH = os.path.expanduser("~/tv_watch_log.csv")
 DETECTIONS_DIR = os.path.expanduser("~/detections")
@@ -2958,6 +3257,100 @@ def get_first_registered_date():
                         pass
     return datetime.fromtimestamp(earliest) if earliest else None
 
+class DashboardAggregator:
+    """/api/dashboard の検出ログ（recent_grouped）を、ログに追記された行だけ読んで更新する
+
+    前回読み終えた位置（CSV は inode とバイト位置、SQLite は id）を覚えておき、
+    新しい行だけを検出ログのグループに足し込む。
+    ログの作り直し（rotate_logs.py）・書き直しを検出したときは作り直す。
+    視聴時間と直近3時間の検出は rollup_store の集計から返す。
+    none・未登録の名前は足し込む前に除く（登録済みラベルが変わったら作り直す）。
+    """
+
+    RECENT_GROUPS = 50
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self.rebuilds = 0
+
+    def _reset(self, key):
+        self._key = key
+        self._cursor = None
+        self.groups = deque(maxlen=self.RECENT_GROUPS)
+        self.rebuilds += 1
+
+    def invalidate(self):
+        """ログの既存行を書き換えたときに呼ぶ（次の読み込みで作り直す）"""
+        with self._lock:
+            self._key = None
+
+    def _add(self, ts_key, name, start, first_registered, registered):
+        if ts_key < start:
+            return
+        # 登録済みラベルのみ
+        if name not in registered:
+            return
+        # 登録前のデータは無視
+        if first_registered and datetime.strptime(ts_key, "%Y-%m-%d %H:%M:%S") < first_registered:
+            return
+        # 検出ログのグループ化（同じ秒は1レコード）
+        if self.groups and self.groups[-1]["timestamp"] == ts_key:
+            if name not in self.groups[-1]["names"]:
+                self.groups[-1]["names"].append(name)
+        else:
+            self.groups.append({"timestamp": ts_key, "names": [name]})
+
+    def update(self, config, registered, first_registered, start):
+        """ログの新しい行を足し込む"""
+        key = (config.get("log_backend", "csv"), config.get("log_path"), config.get("log_db_path"),
+               registered, first_registered)
+        if key != self._key:
+            self._reset(key)
+        store = open_log_store(config)
+        try:
+            # 作り直すときは二分探索で start の位置から読む
+            rows, cursor, reset = store.read_since(self._cursor, start=start)
+        finally:
+            store.close()
+        if reset and self._cursor is not None:
+            # ローテーション・書き直し: 先頭から読み直した rows で作り直す
+            self._reset(key)
+        self._cursor = cursor
+        for ts_key, name in rows:
+            try:
+                self._add(ts_key, name, start, first_registered, registered)
+            except ValueError:
+                continue
+
+    def recent_grouped(self, config, registered_labels, first_registered, start, limit=50):
+        """登録済みラベルに絞った新しい順の検出ログ（start 以降）"""
+        with self._lock:
+            self.update(config, frozenset(registered_labels), first_registered, start)
+            recent_grouped = []
+            for group in reversed(self.groups):
+                if group["timestamp"] < start or len(recent_grouped) >= limit:
+                    break
+                # 検出画像ファイル名を生成
+                img_ts = group["timestamp"].replace("-", "").replace(":", "").replace(" ", "_")
+                recent_grouped.append({"timestamp": group["timestamp"], "names": list(group["names"]),
+                                       "images": [f"detection_{img_ts}_{n}.jpg" for n in group["names"]]})
+        return recent_grouped
+
+dashboard_aggregator = DashboardAggregator()
+
+def invalidate_log_aggregates(config):
+    """再ラベル・削除でログの既存行を書き換えたあとに、集計を作り直させる"""
+    dashboard_aggregator.invalidate()
+    try:
+        rollup = open_rollup_store(config)
+        try:
+            rollup.invalidate()
+        finally:
+            rollup.close()
+    except:
+        pass
+
 last_detection_image = None
 last_detection_meta = None
 
@@ -2965,86 +3358,58 @@ last_detection_meta = None
 def api_dashboard():
     global last_detection_image, last_detection_meta
     config = load_config()
-    log_path = os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
-    # 視聴中断とみなす閾値（秒）- この時間以上空いたら別セッション
-    gap_threshold_sec = 120  # 2分
-
     registered_labels = get_registered_labels()
     first_registered = get_first_registered_date()
 
     now = datetime.now()
-    today_str = now.strftime("%Y-%m-%d")
     cutoff = now - timedelta(days=7)
     three_hours_ago = now - timedelta(hours=3)
 
-    daily_minutes = defaultdict(lambda: defaultdict(float))
-    recent_grouped = []
+    daily_minutes = {}
     detection_3h = {name: [False] * 180 for name in registered_labels}  # 3時間 = 180分
 
-    current_group = None
-    # 各人物・各日の最後の検出時刻を追跡
-    last_detection_by_name_date = defaultdict(dict)  # {name: {date: last_timestamp}}
-
-    if os.path.exists(log_path):
+    # 視聴時間と直近3時間の検出は分単位の集計から
+    try:
+        rollup = open_rollup_store(config)
         try:
-            with open(log_path, newline="", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        ts = datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S")
-                        name = row["name"]
-
-                        # 登録前のデータは無視
-                        if first_registered and ts < first_registered:
-                            continue
-                        if ts < cutoff:
-                            continue
-
-                        # 登録済みラベルのみ
-                        if name not in registered_labels:
-                            continue
-
-                        date_str = ts.strftime("%Y-%m-%d")
-
-                        # タイムスタンプ間の時間を計算
-                        if date_str in last_detection_by_name_date[name]:
-                            last_ts = last_detection_by_name_date[name][date_str]
-                            diff_sec = (ts - last_ts).total_seconds()
-                            # 閾値以内なら視聴時間としてカウント
-                            if 0 < diff_sec <= gap_threshold_sec:
-                                daily_minutes[date_str][name] += diff_sec / 60.0
-                        last_detection_by_name_date[name][date_str] = ts
-
-                        # 直近3時間のバーコード
-                        if ts >= three_hours_ago:
-                            minute_idx = int((ts - three_hours_ago).total_seconds() / 60)
-                            if 0 <= minute_idx < 180:
-                                detection_3h[name][minute_idx] = True
-
-                        # 検出ログのグループ化（同じ秒は1レコード）
-                        ts_key = row["timestamp"]
-                        # 検出画像ファイル名を生成
-                        img_ts = ts.strftime("%Y%m%d_%H%M%S")
-                        if current_group and current_group["timestamp"] == ts_key:
-                            if name not in current_group["names"]:
-                                current_group["names"].append(name)
-                                current_group["images"].append(f"detection_{img_ts}_{name}.jpg")
-                        else:
-                            if current_group:
-                                recent_grouped.append(current_group)
-                            current_group = {"timestamp": ts_key, "names": [name], "images": [f"detection_{img_ts}_{name}.jpg"]}
-                    except:
-                        continue
-                if current_group:
-                    recent_grouped.append(current_group)
-        except:
-            pass
+            rollup.sync(config)
+            daily = rollup.daily(cutoff.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d"),
+                                 since=first_registered)
+            for date_str, by_name in daily.items():
+                minutes = {name: m for name, m in by_name.items() if name in registered_labels}
+                if minutes:
+                    daily_minutes[date_str] = minutes
+            for name, minutes in rollup.detected_minutes(three_hours_ago, now).items():
+                if name not in detection_3h:
+                    continue
+                for ts in minutes:
+                    # 集計は時計の分単位なので、その分の中央で位置を決める
+                    minute_idx = max(0, int((ts - three_hours_ago).total_seconds() + 30) // 60)
+                    if minute_idx < 180:
+                        detection_3h[name][minute_idx] = True
+        finally:
+            rollup.close()
+    except:
+        pass
 
-    recent_grouped = recent_grouped[-50:][::-1]
+    # 検出ログは前回からログに追記された行だけを読んで更新する
+    try:
+        recent_grouped = dashboard_aggregator.recent_grouped(
+            config, registered_labels, first_registered, cutoff.strftime("%Y-%m-%d %H:%M:%S"))
+    except:
+        # 読み込みに失敗したら次回は作り直す
+        dashboard_aggregator.invalidate()
+        recent_grouped = []
 
     # 直近の画像（detectionsフォルダ優先、なければcaptures）
     latest_image = None
-    if os.path.exists(DETECTIONS_DIR):
+    latest = read_service_frame()
+    if latest is not None:
+        # 共有メモリの最新フレーム（/api/latest_image が直接返す）
+        latest_image = "latest_frame.jpg"
+        last_detection_image = None
+        last_detection_meta = latest.meta
+    elif os.path.exists(DETECTIONS_DIR):
         # latest_frame.jpg を優先
         latest_frame_path = os.path.join(DETECTIONS_DIR, "latest_frame.jpg")
         if os.path.exists(latest_frame_path):
@@ -3089,7 +3454,7 @@ def api_dashboard():
             pass
 
     return jsonify({
-        "daily": {k: dict(v) for k, v in daily_minutes.items()},
+        "daily": daily_minutes,
         "registered_labels": registered_labels,
         "latest_image": latest_image,
         "detection_3h": detection_3h,
@@ -3102,6 +3467,21 @@ def api_latest_image():
     """直近画像をROI/BBox表示切替で返す"""
     show_roi = request.args.get('roi', 'true').lower() == 'true'
     show_bbox = request.args.get('bbox', 'true').lower() == 'true'
+    config = load_config()
+    roi = get_roi_by_index(config.get('roi_index')) if show_roi else None
+
+    # 共有メモリの最新フレームを優先（SDカードを経由しない）
+    for _ in range(2):
+        latest = read_service_frame()
+        if latest is None:
+            break
+        meta = latest.meta if show_bbox else None
+        draw = None
+        if roi or (meta and meta.get('faces')):
+            draw = lambda img: draw_latest_overlays(img, roi, meta)
+        jpeg = encode_channel_frame(latest, draw)
+        if jpeg is not None:
+            return Response(jpeg, mimetype='image/jpeg')
 
     # クリーンな画像（オーバーレイなし）を優先使用
     clean_path = os.path.join(DETECTIONS_DIR, "latest_frame_clean.jpg")
@@ -3115,18 +3495,19 @@ def api_latest_image():
     if img is None:
         return "Failed to load", 500
 
-    config = load_config()
+    draw_latest_overlays(img, roi, last_detection_meta if show_bbox else None)
+    _, jpeg = cv2.imencode('.jpg', img)
+    return Response(jpeg.tobytes(), mimetype='image/jpeg')
 
+def draw_latest_overlays(img, roi, meta):
+    """直近画像にROI枠（設定中のROI）と検出BBoxを描画する"""
     # ROI描画
-    if show_roi:
-        roi_index = config.get('roi_index')
-        roi = get_roi_by_index(roi_index)
-        if roi:
-            cv2.rectangle(img, (roi['x'], roi['y']), (roi['x']+roi['w'], roi['y']+roi['h']), (0, 212, 255), 2)
+    if roi:
+        cv2.rectangle(img, (roi['x'], roi['y']), (roi['x']+roi['w'], roi['y']+roi['h']), (0, 212, 255), 2)
 
     # BBox描画（メタデータがある場合）
-    if show_bbox and last_detection_meta:
-        faces = last_detection_meta.get('faces', [])
+    if meta:
+        faces = meta.get('faces', [])
         for face in faces:
             bbox = face.get('bbox', {})
             if bbox:
@@ -3144,12 +3525,17 @@ def api_latest_image():
                 label = f"{name} ({similarity:.0f}%)" if similarity else name
                 cv2.putText(img, label, (left, top-10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
 
-    _, jpeg = cv2.imencode('.jpg', img)
-    return Response(jpeg.tobytes(), mimetype='image/jpeg')
-
 @app.route("/api/service_frame")
 def api_service_frame():
     """サービスが撮像中の最新フレームを返す"""
+    for _ in range(2):
+        latest = read_service_frame(max_age_sec=60)
+        if latest is None:
+            break
+        jpeg = encode_channel_frame(latest, lambda img: draw_service_overlays(img, latest.meta))
+        if jpeg is not None:
+            return Response(jpeg, mimetype='image/jpeg')
+
     latest_path = os.path.join(DETECTIONS_DIR, "latest_frame.jpg")
     if os.path.exists(latest_path):
         # ファイルの更新時間をチェック（60秒以内なら有効）
@@ -3169,43 +3555,31 @@ def api_distribution():
         return jsonify({"error": "date required"})
 
     config = load_config()
-    log_path = os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
-    gap_threshold_sec = 120  # 2分
     registered_labels = get_registered_labels()
 
-    hourly = defaultdict(lambda: defaultdict(float))
-    # 各人物の最後の検出時刻を追跡
-    last_detection_by_name = {}
+    try:
+        day_start = datetime.strptime(date, "%Y-%m-%d")
+    except:
+        return jsonify({"error": "invalid date format"})
 
-    if os.path.exists(log_path):
+    # 分単位の集計を時間帯ごとに足し合わせる（時間をまたぐ視聴は検出した時間帯に計上）
+    hourly = {}
+    try:
+        rollup = open_rollup_store(config)
         try:
-            with open(log_path, newline="", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        ts = datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S")
-                        name = row["name"]
-                        if name not in registered_labels:
-                            continue
-                        date_str = ts.strftime("%Y-%m-%d")
-                        if date_str == date:
-                            hour_str = ts.strftime("%H")
-                            # タイムスタンプ間の時間を計算
-                            if name in last_detection_by_name:
-                                last_ts = last_detection_by_name[name]
-                                diff_sec = (ts - last_ts).total_seconds()
-                                if 0 < diff_sec <= gap_threshold_sec:
-                                    # 時間をまたぐ場合は現在の時間帯に計上
-                                    hourly[hour_str][name] += diff_sec / 60.0
-                            last_detection_by_name[name] = ts
-                    except:
-                        continue
-        except:
-            pass
+            rollup.sync(config)
+            for hour_str, by_name in rollup.hourly(day_start.strftime("%Y-%m-%d")).items():
+                minutes = {name: m for name, m in by_name.items() if name in registered_labels}
+                if minutes:
+                    hourly[hour_str] = minutes
+        finally:
+            rollup.close()
+    except:
+        pass
 
     return jsonify({
         "date": date,
-        "hourly": {k: dict(v) for k, v in hourly.items()},
+        "hourly": hourly,
         "labels": registered_labels
     })
 
@@ -3218,8 +3592,6 @@ def api_trend():
         return jsonify({"error": "start and end required"})
 
     config = load_config()
-    log_path = os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
-    gap_threshold_sec = 120  # 2分
     registered_labels = get_registered_labels()
 
     try:
@@ -3228,34 +3600,21 @@ def api_trend():
     except:
         return jsonify({"error": "invalid date format"})
 
-    daily = defaultdict(lambda: defaultdict(float))
-    # 各人物・各日の最後の検出時刻を追跡
-    last_detection_by_name_date = defaultdict(dict)
-
-    if os.path.exists(log_path):
+    # 分単位の集計を日ごとに足し合わせる
+    daily = {}
+    try:
+        rollup = open_rollup_store(config)
         try:
-            with open(log_path, newline="", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        ts = datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S")
-                        name = row["name"]
-                        if name not in registered_labels:
-                            continue
-                        date_str = ts.strftime("%Y-%m-%d")
-                        row_date = datetime.strptime(date_str, "%Y-%m-%d")
-                        if start_date <= row_date <= end_date:
-                            # タイムスタンプ間の時間を計算
-                            if date_str in last_detection_by_name_date[name]:
-                                last_ts = last_detection_by_name_date[name][date_str]
-                                diff_sec = (ts - last_ts).total_seconds()
-                                if 0 < diff_sec <= gap_threshold_sec:
-                                    daily[date_str][name] += diff_sec / 60.0
-                            last_detection_by_name_date[name][date_str] = ts
-                    except:
-                        continue
-        except:
-            pass
+            rollup.sync(config)
+            for date_str, by_name in rollup.daily(start_date.strftime("%Y-%m-%d"),
+                                                  end_date.strftime("%Y-%m-%d")).items():
+                minutes = {name: m for name, m in by_name.items() if name in registered_labels}
+                if minutes:
+                    daily[date_str] = minutes
+        finally:
+            rollup.close()
+    except:
+        pass
 
     # 日付リストを生成
     dates = []
@@ -3268,7 +3627,7 @@ def api_trend():
         "start": start,
         "end": end,
         "dates": dates,
-        "daily": {k: dict(v) for k, v in daily.items()},
+        "daily": daily,
         "labels": registered_labels
     })
 
@@ -3344,8 +3703,7 @@ def api_delete_label():
                     new_encodings.append(enc)
                     new_names.append(n)
 
-            with open(ENCODINGS_PATH, 'wb') as f:
-                pickle.dump({'encodings': new_encodings, 'names': new_names}, f)
+            save_encodings({'encodings': new_encodings, 'names': new_names})
         except Exception as e:
             return jsonify({"success": False, "error": str(e)})
 
@@ -3408,8 +3766,7 @@ def api_rename_label():
             new_names = [new_name if n == old_name else n for n in enc_data.get('names', [])]
             enc_data['names'] = new_names
 
-            with open(ENCODINGS_PATH, 'wb') as f:
-                pickle.dump(enc_data, f)
+            save_encodings(enc_data)
         except Exception as e:
             return jsonify({"success": False, "error": f"エンコード更新エラー: {str(e)}"})
 
@@ -3555,33 +3912,19 @@ def api_relabel_detection():
         with open(meta_path, 'w') as f:
             json.dump(meta, f)
 
-        # CSVログも更新
+        # 視聴ログも更新
         config = load_config()
-        log_path = os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
 
-        # タイムスタンプをCSV形式に変換 (YYYYMMDD_HHMMSS -> YYYY-MM-DD HH:MM:SS)
+        # タイムスタンプをログ形式に変換 (YYYYMMDD_HHMMSS -> YYYY-MM-DD HH:MM:SS)
         ts_csv = f"{timestamp[:4]}-{timestamp[4:6]}-{timestamp[6:8]} {timestamp[9:11]}:{timestamp[11:13]}:{timestamp[13:15]}"
 
-        if os.path.exists(log_path):
-            # CSVを読み込んで更新
-            rows = []
-            updated = False
-            with open(log_path, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                fieldnames = reader.fieldnames
-                for row in reader:
-                    if row['timestamp'] == ts_csv:
-                        for update in updates:
-                            if row['name'] == update['old_name']:
-                                row['name'] = update['new_name']
-                                updated = True
-                    rows.append(row)
-
-            if updated:
-                with open(log_path, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(rows)
+        store = open_log_store(config)
+        try:
+            # CSV は書き直しが1回で済むようにまとめて変える
+            store.relabel_many(ts_csv, [(u['old_name'], u['new_name']) for u in updates])
+        finally:
+            store.close()
+        invalidate_log_aggregates(config)
 
         # 自動エンコード（保存した顔のラベルごとに実行）
         encoded_labels = set()
@@ -3615,26 +3958,18 @@ def api_delete_detection():
             for f in glob.glob(os.path.join(DETECTIONS_DIR, pattern)):
                 os.remove(f)
 
-        # CSVログから削除
+        # 視聴ログから削除
         config = load_config()
-        log_path = os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
 
-        # タイムスタンプをCSV形式に変換
+        # タイムスタンプをログ形式に変換
         ts_csv = f"{timestamp[:4]}-{timestamp[4:6]}-{timestamp[6:8]} {timestamp[9:11]}:{timestamp[11:13]}:{timestamp[13:15]}"
 
-        if os.path.exists(log_path):
-            rows = []
-            with open(log_path, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                fieldnames = reader.fieldnames
-                for row in reader:
-                    if row['timestamp'] != ts_csv:
-                        rows.append(row)
-
-            with open(log_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(rows)
+        store = open_log_store(config)
+        try:
+            store.delete(ts_csv)
+        finally:
+            store.close()
+        invalidate_log_aggregates(config)
 
         return jsonify({"success": True})
     except Exception as e:
@@ -3680,6 +4015,19 @@ def api_applied_config():
     # フォールバック: 保存済み設定を返す
     return jsonify({"running": True, "config": load_config(), "mtime": None})
 
+@app.route("/api/metrics")
+def api_metrics():
+    """サービスが書き出した処理段階ごとの所要時間とリソース状況を返す"""
+    if not is_service_running():
+        return jsonify({"running": False, "metrics": None})
+    metrics_path = os.path.expanduser(load_config().get("metrics_path", "~/tv_watch_metrics.json"))
+    try:
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        return jsonify({"running": True, "metrics": None})
+    return jsonify({"running": True, "metrics": metrics, "age_sec": round(time.time() - metrics.get("updated_at", 0), 1)})
+
 @app.route("/api/service_control", methods=["POST"])
 def api_service_control():
     action = request.json.get("action")
@@ -3704,11 +4052,15 @@ def api_save_config():
     try:
         config = load_config()
         updates = request.json
-        for key in ["face_model", "upsample", "interval_sec", "tolerance", "roi_index"]:
+        for key in ["face_model", "upsample", "interval_sec", "tolerance", "roi_index", "resize_width"]:
             if key in updates:
                 config[key] = updates[key]
         save_config(config)
-        return jsonify({"success": True})
+        # 稼働中のトラッカーに再読込を要求（使えなければフロントエンドが再起動する）
+        result = send_tracker_command("reload")
+        if result and result.get("success"):
+            return jsonify({"success": True, "live": True, "applied": result.get("config")})
+        return jsonify({"success": True, "live": False})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
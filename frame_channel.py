@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+トラッカーの最新フレームを Web UI と共有するチャンネル
+
+/dev/shm 上のファイルをメモリマップし、数枚分のスロットを持つリングバッファとして使う。
+トラッカー（書き手）は生フレーム（BGR）とメタデータ（JSON）を次のスロットに書き、
+ヘッダの通し番号を進める。Web UI（読み手）は通し番号のスロットをコピーせずに参照する。
+
+レイアウト:
+    ファイルヘッダ  magic, version, スロット数, フレーム容量, メタ容量, 最新の通し番号
+    スロット × N    通し番号（書き込み中は0）, 高さ, 幅, チャンネル数, メタ長, 撮影時刻
+                    + フレーム（容量分） + メタデータ（容量分）
+
+フレームが容量を超えたら、書き手は新しいファイルを作って rename で差し替える。
+読み手は inode の変化で作り直しに気づいて開き直す。
+"""
+import os
+import json
+import mmap
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_PATH = "/dev/shm/tv_watch_latest_frame"
+
+MAGIC = b"TVFC"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sIIIIQ")  # magic, version, slots, frame_capacity, meta_capacity, latest_seq
+SLOT_HEADER = struct.Struct("<QIIIId")  # seq, height, width, channels, meta_len, captured_at
+HEADER_SIZE = 64  # 各ヘッダは64バイト境界にそろえる
+LATEST_SEQ_OFFSET = FILE_HEADER.size - 8
+
+# buffer / offset は is_current() で使うスロットの位置
+LatestFrame = namedtuple("LatestFrame", ["seq", "captured_at", "frame", "meta", "buffer", "offset"])
+
+def default_path(config):
+    """設定の frame_channel_path（空文字なら無効で None）を返す"""
+    path = config.get("frame_channel_path", DEFAULT_PATH)
+    if not path:
+        return None
+    return os.path.expanduser(path)
+
+def _align(n):
+    return (n + HEADER_SIZE - 1) // HEADER_SIZE * HEADER_SIZE
+
+def _slot_size(frame_capacity, meta_capacity):
+    return HEADER_SIZE + _align(frame_capacity) + _align(meta_capacity)
+
+class FrameChannelWriter:
+    """トラッカー側: 最新フレームとメタデータをリングに書き込む"""
+
+    def __init__(self, path=DEFAULT_PATH, slots=3, meta_capacity=64 * 1024):
+        self.path = path
+        self.slots = max(2, int(slots))
+        self.meta_capacity = meta_capacity
+        self.frame_capacity = 0
+        self.seq = 0
+        self.published = 0
+        self._mm = None
+
+    def _create(self, frame_capacity, meta_capacity):
+        self.close()
+        slot_size = _slot_size(frame_capacity, meta_capacity)
+        size = HEADER_SIZE + slot_size * self.slots
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        FILE_HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.slots, frame_capacity, meta_capacity, self.seq)
+        os.replace(tmp_path, self.path)
+        self.frame_capacity = frame_capacity
+        self.meta_capacity = meta_capacity
+        self._slot_size = slot_size
+
+    def publish(self, frame, meta, captured_at=None):
+        """フレーム（uint8 の HxWxC）とメタデータ（JSON化できる dict）を書き込む"""
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.ndim == 2:
+            frame = frame[:, :, None]
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        if (self._mm is None or frame.nbytes > self.frame_capacity
+                or len(meta_bytes) > self.meta_capacity):
+            self._create(max(frame.nbytes, self.frame_capacity),
+                         max(_align(len(meta_bytes)), self.meta_capacity))
+
+        seq = self.seq + 1
+        offset = HEADER_SIZE + (seq % self.slots) * self._slot_size
+        frame_offset = offset + HEADER_SIZE
+        meta_offset = frame_offset + _align(self.frame_capacity)
+        height, width, channels = frame.shape
+        captured_at = time.time() if captured_at is None else captured_at
+
+        # 書き込み中は通し番号を0にして、読み手にこのスロットを使わせない
+        SLOT_HEADER.pack_into(self._mm, offset, 0, height, width, channels, len(meta_bytes), captured_at)
+        self._mm[frame_offset:frame_offset + frame.nbytes] = frame.data.cast("B")
+        self._mm[meta_offset:meta_offset + len(meta_bytes)] = meta_bytes
+        struct.pack_into("<Q", self._mm, offset, seq)
+        struct.pack_into("<Q", self._mm, LATEST_SEQ_OFFSET, seq)
+        self.seq = seq
+        self.published += 1
+
+    def close(self, unlink=False):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if unlink:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"seq": self.seq, "published": self.published,
+                "frame_capacity": self.frame_capacity}
+
+class FrameChannelReader:
+    """Web UI 側: 最新フレームをコピーせずに参照する
+
+    latest() が返すフレームは共有メモリのビュー（読み取り専用）。
+    書き手がリングを一周するとそのスロットは上書きされるので、
+    使い終わったら is_current() で上書きされていないか確かめる。
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mm = None
+        self._inode = None
+
+    def _open(self):
+        """ファイルが作り直されていれば開き直す。開けなければ False"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._mm = None
+            return False
+        if self._mm is not None and st.st_ino == self._inode:
+            return True
+        try:
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        magic, version, slots, frame_capacity, meta_capacity, _ = FILE_HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            return False
+        # 古いビューが残っていても、参照がなくなれば古いマップは閉じられる
+        self._mm = mm
+        self._inode = st.st_ino
+        self.slots = slots
+        self.frame_capacity = frame_capacity
+        self._slot_size = _slot_size(frame_capacity, meta_capacity)
+        return True
+
+    def _slot_offset(self, seq):
+        return HEADER_SIZE + (seq % self.slots) * self._slot_size
+
+    def latest(self, retries=3):
+        """最新の LatestFrame を返す。まだ何も書かれていなければ None"""
+        with self._lock:
+            for _ in range(retries):
+                if not self._open():
+                    return None
+                mm = self._mm
+                seq = struct.unpack_from("<Q", mm, LATEST_SEQ_OFFSET)[0]
+                if seq == 0:
+                    return None
+                offset = self._slot_offset(seq)
+                slot_seq, height, width, channels, meta_len, captured_at = SLOT_HEADER.unpack_from(mm, offset)
+                if slot_seq != seq:
+                    continue  # 書き込み中か、すでに次の周回で上書きされた
+                frame_offset = offset + HEADER_SIZE
+                meta_offset = frame_offset + _align(self.frame_capacity)
+                frame = np.frombuffer(mm, dtype=np.uint8, count=height * width * channels,
+                                      offset=frame_offset).reshape(height, width, channels)
+                try:
+                    meta = json.loads(mm[meta_offset:meta_offset + meta_len])
+                except ValueError:
+                    continue
+                if struct.unpack_from("<Q", mm, offset)[0] != seq:
+                    continue
+                return LatestFrame(seq, captured_at, frame, meta, mm, offset)
+            return None
+
+    @staticmethod
+    def is_current(latest):
+        """latest のスロットがまだ上書きされていなければ True"""
+        return struct.unpack_from("<Q", latest.buffer, latest.offset)[0] == latest.seq
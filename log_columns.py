@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+視聴ログの列形式（NumPy）での読み込みと集計
+
+ログを1行ずつ strptime・csv で読む代わりに、
+  epoch  int64   秒（"YYYY-MM-DD HH:MM:SS" をそのまま秒に直した値。タイムゾーン変換はしない）
+  codes  uint8   人物のコード（labels の添字。人物が256を超えるときは uint16）
+の2列にまとめ、視聴時間の計算と分単位の集計をまとめて行う。
+
+timestamp は固定幅なので、各桁を切り出して数値にする（strptime は使わない）。
+CSV のバイト列からは改行位置を探し、行頭からの固定位置を拾って列にする。
+大きなログは BLOCK_BYTES ごとに行単位で区切って変換し、作業用の配列がログ全体の大きさにならないようにする。
+
+視聴秒数の数え方は従来どおり:
+  同じ人物の同じ日の前回検出から gap_threshold_sec 以内なら、その間隔を今回の検出に計上する
+"""
+import csv
+
+import numpy as np
+
+TS_WIDTH = 19  # "YYYY-MM-DD HH:MM:SS"
+MAX_NAME_BYTES = 64
+BLOCK_BYTES = 4 * 1024 * 1024  # 一度に変換するバイト数（作業用配列のメモリを抑える）
+NO_PREVIOUS = np.iinfo(np.int64).min // 2  # 前回検出なし
+
+def _digits(chars, positions):
+    """各行の positions の桁を10進数として読む。数字以外を含む行は -1"""
+    value = np.zeros(len(chars), dtype=np.int64)
+    valid = np.ones(len(chars), dtype=bool)
+    for pos in positions:
+        digit = chars[:, pos].astype(np.int64) - 48
+        valid &= (digit >= 0) & (digit <= 9)
+        value = value * 10 + digit
+    return np.where(valid, value, -1)
+
+def parse_timestamps(chars):
+    """timestamp の文字（行数 x 19 の uint8）から (epoch 秒, 有効か) を返す
+
+    日付は days_from_civil（グレゴリオ暦の通算日）で計算する。
+    """
+    year = _digits(chars, (0, 1, 2, 3))
+    month = _digits(chars, (5, 6))
+    day = _digits(chars, (8, 9))
+    hour = _digits(chars, (11, 12))
+    minute = _digits(chars, (14, 15))
+    second = _digits(chars, (17, 18))
+    valid = ((year >= 1970) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+             & (hour >= 0) & (hour <= 23) & (minute >= 0) & (minute <= 59)
+             & (second >= 0) & (second <= 59))
+    for pos, sep in ((4, b"-"), (7, b"-"), (10, b" "), (13, b":"), (16, b":")):
+        valid &= chars[:, pos] == ord(sep)
+
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    epoch = days * 86400 + hour * 3600 + minute * 60 + second
+    return epoch, valid
+
+def iter_line_blocks(f, limit=None, block_bytes=BLOCK_BYTES):
+    """f の現在位置から limit バイト（None なら終わりまで）を、行の途中で切らずに block_bytes 前後ずつ返す"""
+    carry = b""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        data = f.read(block_bytes if remaining is None else min(block_bytes, remaining))
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        data = carry + data
+        cut = data.rfind(b"\n") + 1
+        carry = data[cut:]
+        if cut:
+            yield data[:cut]
+    if carry:
+        # 改行で終わっていない最終行（アーカイブの末尾など）
+        yield carry + b"\n"
+
+def _encode_names(names):
+    """名前（固定長 bytes の配列）を (codes, labels) にする"""
+    width = names.dtype.itemsize
+    if len(names) and width <= 8:
+        # 8バイト以下なら整数として扱うと速い（ほとんどの名前はこちら）
+        keys = np.zeros((len(names), 8), dtype=np.uint8)
+        keys[:, :width] = names.view(np.uint8).reshape(-1, width)
+        _, first, codes = np.unique(keys.view(np.uint64).ravel(),
+                                    return_index=True, return_inverse=True)
+        labels = names[first]
+    else:
+        labels, codes = np.unique(names, return_inverse=True)
+    decoded = []
+    for label in labels:
+        text = label.decode("utf-8", errors="replace")
+        if text.startswith('"'):
+            # CSV で引用符付きになった名前
+            text = next(csv.reader([text]))[0]
+        decoded.append(text)
+    dtype = np.uint8 if len(decoded) <= 256 else np.uint16
+    return codes.astype(dtype), decoded
+
+class LogColumns:
+    """視聴ログの列（時刻順）"""
+
+    def __init__(self, epoch, codes, labels):
+        self.epoch = epoch
+        self.codes = codes
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.epoch)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), [])
+
+    @classmethod
+    def from_rows(cls, rows):
+        """(timestamp, name) のリストから作る"""
+        if not rows:
+            return cls.empty()
+        ts = np.array([row[0] for row in rows], dtype=f"S{TS_WIDTH}")
+        chars = ts.view(np.uint8).reshape(-1, TS_WIDTH)
+        epoch, valid = parse_timestamps(chars)
+        valid &= np.array([len(row[0]) == TS_WIDTH for row in rows])
+        names = np.array([row[1].encode("utf-8") for row in rows], dtype=object)
+        codes, labels = _encode_names(names[valid].astype(bytes))
+        return cls(epoch[valid], codes, labels)
+
+    @classmethod
+    def from_row_batches(cls, batches):
+        """(timestamp, name) のリストを少しずつ受け取って作る（SQLite の fetchmany など）"""
+        return cls._merge([cls.from_rows(rows) for rows in batches])
+
+    @classmethod
+    def from_csv_blocks(cls, blocks):
+        """行単位に区切ったバイト列（iter_line_blocks）から作る"""
+        return cls._merge([cls.from_csv_bytes(block) for block in blocks])
+
+    @classmethod
+    def from_csv_bytes(cls, data):
+        """CSV のバイト列（改行で終わる行のみ）から作る。ヘッダ行と壊れた行は除く"""
+        buf = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(buf == ord("\n"))
+        if len(ends) == 0:
+            return cls.empty()
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        # 末尾の \r を除いた名前の長さ
+        name_ends = ends - (buf[ends - 1] == ord("\r"))
+        lengths = name_ends - starts - (TS_WIDTH + 1)
+        ok = (lengths > 0) & (lengths <= MAX_NAME_BYTES)
+        starts, lengths = starts[ok], lengths[ok]
+        ok = buf[starts + TS_WIDTH] == ord(",")
+        starts, lengths = starts[ok], lengths[ok]
+        if len(starts) == 0:
+            return cls.empty()
+
+        # 行頭から固定幅の窓を切り出す。窓が末尾からはみ出す最後の数行だけ 0 で埋めた写しから取る
+        width = int(lengths.max())
+        size = TS_WIDTH + 1 + width
+        fit = int(np.searchsorted(starts, len(buf) - size, side="right"))
+        tail_from = int(starts[fit]) if fit < len(starts) else len(buf)
+        tail = np.concatenate([buf[tail_from:], np.zeros(size, dtype=np.uint8)])
+        chars = np.lib.stride_tricks.sliding_window_view(tail, size)[starts[fit:] - tail_from]
+        if fit:
+            chars = np.concatenate([np.lib.stride_tricks.sliding_window_view(buf, size)[starts[:fit]], chars])
+        epoch, valid = parse_timestamps(chars[:, :TS_WIDTH])
+        name_chars = chars[valid, TS_WIDTH + 1:]
+        # 名前の後ろ（\r\n と次の行）は 0 で埋めて固定長の bytes にする
+        name_chars[np.arange(width) >= lengths[valid][:, None]] = 0
+        codes, labels = _encode_names(name_chars.view(f"S{width}").ravel())
+        return cls(epoch[valid], codes, labels)
+
+    @classmethod
+    def _merge(cls, parts):
+        """ブロックごとの LogColumns を時刻順につなぐ（名前のコードは振り直す）"""
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls.empty()
+        labels = sorted({label for p in parts for label in p.labels})
+        index = {label: i for i, label in enumerate(labels)}
+        dtype = np.uint8 if len(labels) <= 256 else np.uint16
+        codes = [np.array([index[l] for l in p.labels], dtype=dtype)[p.codes] for p in parts]
+        return cls(np.concatenate([p.epoch for p in parts]), np.concatenate(codes), labels)
+
+    def split(self, rows):
+        """rows 行ずつの LogColumns に分ける（配列はビューなのでコピーしない）"""
+        for i in range(0, len(self), rows):
+            yield LogColumns(self.epoch[i:i + rows], self.codes[i:i + rows], self.labels)
+
+    def watch_seconds(self, gap_threshold_sec, last_seen=None):
+        """各行に計上する視聴秒数を返す。last_seen（{name: epoch}）は各人物の最後の検出で更新される
+
+        人物ごとに時刻順に並べ、直前の検出との差（np.diff 相当）を同じ日・閾値以内のときだけ計上する。
+        """
+        n = len(self.epoch)
+        seconds = np.zeros(n, dtype=np.float64)
+        if n == 0:
+            return seconds
+        last_seen = {} if last_seen is None else last_seen
+
+        # 人物ごと（同じ人物の中では元の時刻順）に並べる
+        order = np.argsort(self.codes, kind="stable")
+        epoch = self.epoch[order]
+        codes = self.codes[order]
+        first = np.ones(n, dtype=bool)
+        first[1:] = codes[1:] != codes[:-1]
+
+        # 直前の検出との差。人物の最初の行は前回までの最後の検出との差
+        diff = np.empty(n, dtype=np.int64)
+        np.subtract(epoch[1:], epoch[:-1], out=diff[1:])
+        carried = np.array([last_seen.get(label, NO_PREVIOUS) for label in self.labels], dtype=np.int64)
+        diff[first] = epoch[first] - carried[codes[first]]
+
+        # 差がその日の 0 時からの秒数以下なら、直前の検出は同じ日
+        credit = (diff > 0) & (diff <= gap_threshold_sec)
+        credit &= diff <= epoch % 86400
+        seconds[order[credit]] = diff[credit]
+
+        # 人物ごとの最後の検出
+        last = np.ones(n, dtype=bool)
+        last[:-1] = codes[:-1] != codes[1:]
+        for code, ts in zip(codes[last], epoch[last]):
+            last_seen[self.labels[code]] = int(ts)
+        return seconds
+
+    def minute_totals(self, seconds):
+        """(日, 分, 人物) ごとの視聴秒数と検出回数を bincount で集計する
+
+        [(日 "YYYY-MM-DD", 分 0-1439, 名前, 秒, 回数)] を返す。
+        """
+        if len(self.epoch) == 0:
+            return []
+        n_labels = max(len(self.labels), 1)
+        keys = self.epoch // 60  # 1970-01-01 からの通算分
+        keys *= n_labels
+        keys += self.codes
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        totals = np.bincount(inverse, weights=seconds)
+        counts = np.bincount(inverse)
+
+        codes = unique_keys % n_labels
+        minutes = unique_keys // n_labels
+        days = (minutes // 1440).astype("timedelta64[D]") + np.datetime64("1970-01-01", "D")
+        day_strings = days.astype(str)
+        minute_of_day = minutes % 1440
+        return [(str(day), int(minute), self.labels[code], float(total), int(count))
+                for day, minute, code, total, count
+                in zip(day_strings, minute_of_day, codes, totals, counts)]
+
+    def day_string(self, i):
+        """i 行目の日付 "YYYY-MM-DD" """
+        return str(np.datetime64(int(self.epoch[i] // 86400), "D"))
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""
+視聴ログの保存先（バックエンド）
+
+- csv:    tv_watch_log.csv（従来形式。追記のみ、更新・削除はファイル全体を書き直す）
+- sqlite: SQLite データベース（WAL モード、(timestamp, name) インデックス付き）
+
+どちらも timestamp は "YYYY-MM-DD HH:MM:SS" 形式の文字列で扱う。
+この形式は文字列比較がそのまま時刻順になるため、範囲指定も文字列で行う。
+
+CSV には索引ファイル（tv_watch_log.csv.idx）を添える。
+1時間ごとに「その時間の最初の行のバイト位置」を1行ずつ記録したもので、
+トラッカーが追記し、書き直し（rotate_logs.py・再ラベル・削除）のたびに作り直す。
+読み込み側は使う項目がログと合っているか確かめ、合わなければ二分探索で位置を探す。
+
+既存の CSV と rotate_logs.py のアーカイブを SQLite に取り込む:
+    python log_store.py import
+"""
+import io
+import bisect
+import os
+import csv
+import sys
+import glob
+import gzip
+import json
+import sqlite3
+import time
+
+from log_columns import LogColumns, iter_line_blocks
+
+CONFIG_PATH = os.path.expanduser("~/config.json")
+ARCHIVE_DIR = os.path.expanduser("~/tv_watch_archives")
+
+def load_config():
+    defaults = {
+        "log_backend": "csv",
+        "log_path": "~/tv_watch_log.csv",
+        "log_db_path": "~/tv_watch_log.db",
+    }
+    if os.path.exists(CONFIG_PATH):
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            defaults.update(json.load(f))
+    return defaults
+
+def open_log_store(config):
+    """設定の log_backend に応じたログストアを返す"""
+    if config.get("log_backend", "csv") == "sqlite":
+        synchronous = "FULL" if config.get("log_durability") == "fsync" else "NORMAL"
+        return SqliteLogStore(os.path.expanduser(config.get("log_db_path", "~/tv_watch_log.db")),
+                              synchronous=synchronous)
+    return CsvLogStore(os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv")))
+
+TAIL_CHECK_BYTES = 64  # 書き直し検出のため、読み終えた位置の直前を覚えておくバイト数
+SEEK_LINEAR_BYTES = 4096  # 二分探索をやめて先頭から順に読む範囲
+
+def _line_timestamp(line):
+    """CSV の1行（bytes）の timestamp。行として不完全なら None"""
+    if len(line) < 21 or not line.endswith(b"\n") or line[19:20] != b",":
+        return None
+    return line[:19].decode("ascii", errors="replace")
+
+INDEX_HEADER = b"tv_watch_log index v1\n"
+
+def index_path(log_path):
+    return log_path + ".idx"
+
+def read_index(log_path):
+    """索引の [(時間 "YYYY-MM-DD HH", バイト位置)] を時刻順に返す。なければ空"""
+    try:
+        with open(index_path(log_path), "rb") as f:
+            data = f.read()
+    except OSError:
+        return []
+    if not data.startswith(INDEX_HEADER):
+        return []
+    entries = []
+    for line in data[len(INDEX_HEADER):].split(b"\n"):
+        hour, _, offset = line.partition(b",")
+        # 書きかけの最終行（クラッシュ時）や順序の乱れた行は使わない
+        if len(hour) != 13 or not offset.isdigit():
+            continue
+        hour = hour.decode("ascii", errors="replace")
+        if entries and hour <= entries[-1][0]:
+            continue
+        entries.append((hour, int(offset)))
+    return entries
+
+def append_index(log_path, entries, fsync=False):
+    """索引に項目を追記する（トラッカーがログを書き出したあとに呼ぶ）"""
+    with open(index_path(log_path), "ab") as f:
+        if f.tell() == 0:
+            f.write(INDEX_HEADER)
+        f.write(b"".join(f"{hour},{offset}\n".encode("ascii") for hour, offset in entries))
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+
+def write_index(log_path):
+    """ログ全体を読んで索引を作り直す（一時ファイル経由で置き換える）。項目数を返す"""
+    entries = []
+    with open(log_path, "rb") as f:
+        f.readline()  # header
+        pos = f.tell()
+        for line in f:
+            ts = _line_timestamp(line)
+            if ts is not None and (not entries or ts[:13] > entries[-1][0]):
+                entries.append((ts[:13], pos))
+            pos += len(line)
+    tmp_path = index_path(log_path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_HEADER)
+        f.write(b"".join(f"{hour},{offset}\n".encode("ascii") for hour, offset in entries))
+    os.replace(tmp_path, index_path(log_path))
+    return len(entries)
+
+def check_index_entry(f, hour, offset):
+    """offset がその時間の最初の行の行頭なら True（ログが書き直されて索引が古いと False）"""
+    size = os.fstat(f.fileno()).st_size
+    if offset <= 0 or offset >= size:
+        return False
+    back = min(offset, 256)
+    f.seek(offset - back)
+    before = f.read(back)
+    if not before.endswith(b"\n"):
+        return False
+    line = f.readline()
+    ts = _line_timestamp(line)
+    if ts is None or ts[:13] != hour:
+        return False
+    # 直前の行はヘッダか、前の時間の行であること
+    prev = before[before.rfind(b"\n", 0, len(before) - 1) + 1:]
+    prev_ts = _line_timestamp(prev)
+    if prev_ts is None:
+        return prev.startswith(b"timestamp,")
+    return prev_ts[:13] < hour
+
+def _relabel_mapping(changes):
+    """[(old_name, new_name)] を {old_name: new_name} にする（同じ old_name は最初のものを使い、変わらないものは除く）"""
+    mapping = {}
+    for old_name, new_name in changes:
+        mapping.setdefault(old_name, new_name)
+    return {old: new for old, new in mapping.items() if old != new}
+
+class CsvLogStore:
+    """tv_watch_log.csv を読み書きする（従来形式）
+
+    ログは追記のみで時刻順に並んでいるので、期間指定の読み込みは
+    バイト位置の二分探索で開始位置まで飛び、終了時刻を過ぎたら読むのをやめる。
+    """
+
+    backend = "csv"
+
+    def __init__(self, path):
+        self.path = path
+
+    def _index_offset(self, f, start):
+        """索引から start の時間の行頭を探す。索引がない・古いときは None"""
+        entries = read_index(self.path)
+        i = bisect.bisect_right(entries, (start[:13], float("inf"))) - 1
+        if i < 0:
+            return None
+        hour, offset = entries[i]
+        if not check_index_entry(f, hour, offset):
+            return None
+        return offset
+
+    def _start_offset(self, f, start):
+        """start 以上の最初の行より前にある行頭。索引を使い、使えなければ二分探索する"""
+        offset = self._index_offset(f, start)
+        if offset is None:
+            offset = self._seek(f, start)
+        return offset
+
+    def _seek(self, f, start):
+        """start 以上の最初の行より前にある行頭のバイト位置を、二分探索で返す"""
+        size = os.fstat(f.fileno()).st_size
+        f.seek(0)
+        f.readline()  # header
+        lo, hi = f.tell(), size
+        while hi - lo > SEEK_LINEAR_BYTES:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()  # 行の途中に飛ぶので次の行頭にそろえる
+            pos = f.tell()
+            ts = None
+            while ts is None and pos < hi:
+                line = f.readline()
+                if not line:
+                    break
+                ts = _line_timestamp(line)
+                if ts is None:
+                    pos = f.tell()  # 壊れた行は飛ばす
+            if ts is not None and ts < start:
+                lo = pos  # この行までは start より前
+            else:
+                hi = mid
+        return lo
+
+    def iter_rows(self, start=None, end=None):
+        """start 以上 end 未満の (timestamp, name) を時刻順に返す"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as raw:
+            if start is not None:
+                raw.seek(self._start_offset(raw, start))
+            f = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            reader = csv.reader(f)
+            if start is None:
+                next(reader, None)  # header
+            for row in reader:
+                if len(row) < 2 or len(row[0]) != 19:
+                    continue
+                if end is not None and row[0] >= end:
+                    break  # 時刻順なので以降は範囲外
+                if start is None or row[0] >= start:
+                    yield row[0], row[1]
+
+    def _range_since(self, f, cursor, start=None):
+        """read_since で読む範囲。(開始位置, 終了位置, 新しい cursor, reset) を返す
+
+        終了位置は最後の改行の直後（書きかけの最終行は含めない）。
+        """
+        st = os.fstat(f.fileno())
+        reset = (cursor is None or cursor["inode"] != st.st_ino
+                 or st.st_size < cursor["offset"])
+        if not reset and cursor["tail"]:
+            f.seek(cursor["offset"] - len(cursor["tail"]))
+            reset = f.read(len(cursor["tail"])) != cursor["tail"]
+        if not reset:
+            offset = cursor["offset"]
+        elif start is not None:
+            offset = self._start_offset(f, start)
+        else:
+            offset = 0
+
+        # 末尾から最後の改行を探す
+        end = offset
+        pos = st.st_size
+        while pos > offset:
+            block_start = max(offset, pos - 4096)
+            f.seek(block_start)
+            cut = f.read(pos - block_start).rfind(b"\n")
+            if cut >= 0:
+                end = block_start + cut + 1
+                break
+            pos = block_start
+        tail_start = max(0, end - TAIL_CHECK_BYTES)
+        f.seek(tail_start)
+        tail = f.read(end - tail_start)
+        return offset, end, {"inode": st.st_ino, "offset": end, "tail": tail}, reset
+
+    def read_since(self, cursor=None, start=None):
+        """cursor 以降に追記された行を読む。(rows, 新しい cursor, reset) を返す
+
+        cursor は前回読み終えた位置（inode・バイト位置・その直前のバイト列）。
+        ファイルが作り直された（inode が変わった）、切り詰められた、
+        または読み終えた位置の直前が書き換わっていたら先頭から読み直し、reset=True を返す。
+        先頭から読むときに start があれば、start 以上の行から読む。
+        書きかけの最終行は読まずに次回に回す。
+        """
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return [], None, cursor is not None
+        with f:
+            offset, end, cursor, reset = self._range_since(f, cursor, start)
+            f.seek(offset)
+            data = f.read(end - offset)
+        rows = []
+        for row in csv.reader(io.StringIO(data.decode("utf-8", errors="replace"))):
+            # ヘッダ行と壊れた行は timestamp の長さで除く
+            if len(row) >= 2 and len(row[0]) == 19 and (start is None or row[0] >= start):
+                rows.append((row[0], row[1]))
+        return rows, cursor, reset
+
+    def read_columns_since(self, cursor=None):
+        """read_since と同じ範囲を LogColumns（NumPy の列）で返す。大量の行を集計するとき用
+
+        ファイル全体を一度に読まず、行単位のブロックごとに列に変換する。
+        """
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return LogColumns.empty(), None, cursor is not None
+        with f:
+            offset, end, cursor, reset = self._range_since(f, cursor)
+            f.seek(offset)
+            columns = LogColumns.from_csv_blocks(iter_line_blocks(f, limit=end - offset))
+        return columns, cursor, reset
+
+    def _rewrite(self, transform):
+        """全行に transform を適用してファイルを書き直す。変更行数を返す"""
+        if not os.path.exists(self.path):
+            return 0
+        rows = []
+        changed = 0
+        with open(self.path, "r", newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            fieldnames = reader.fieldnames
+            for row in reader:
+                new_row = transform(row)
+                if new_row is not row:
+                    changed += 1
+                if new_row is not None:
+                    rows.append(new_row)
+
+        if changed:
+            with open(self.path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+            # バイト位置がずれるので索引を作り直す
+            if os.path.exists(index_path(self.path)):
+                write_index(self.path)
+        return changed
+
+    def relabel(self, timestamp, old_name, new_name):
+        """指定時刻の old_name の行を new_name に変える"""
+        return self.relabel_many(timestamp, [(old_name, new_name)])
+
+    def relabel_many(self, timestamp, changes):
+        """指定時刻の行の名前を changes（[(old_name, new_name)]）でまとめて変える（書き直しは1回）"""
+        mapping = _relabel_mapping(changes)
+        if not mapping:
+            return 0
+        def transform(row):
+            if row["timestamp"] == timestamp and row["name"] in mapping:
+                return dict(row, name=mapping[row["name"]])
+            return row
+        return self._rewrite(transform)
+
+    def delete(self, timestamp):
+        """指定時刻の行をすべて削除する"""
+        return self._rewrite(lambda row: None if row["timestamp"] == timestamp else row)
+
+    def close(self):
+        pass
+
+class SqliteLogStore:
+    """SQLite に視聴ログを保存する
+
+    WAL モードなのでトラッカーの書き込み中もWeb UIから読める。
+    (timestamp, name) のインデックスで期間指定の読み込みと再ラベル・削除を行う。
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path, synchronous="NORMAL"):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS detections (
+                id INTEGER PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                name TEXT NOT NULL,
+                source_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_detections_ts_name ON detections (timestamp, name);
+            CREATE TABLE IF NOT EXISTS imports (
+                source TEXT PRIMARY KEY,
+                rows INTEGER NOT NULL,
+                imported_at REAL NOT NULL,
+                cursor TEXT
+            );
+        """)
+        # 取り込み元を記録する前に作られたデータベースには列を足す
+        # source_id: 取り込んだ行の imports の rowid（トラッカーが書いた行は NULL）
+        # cursor:    CSV をどこまで取り込んだか（read_since の cursor。NULL は記録前の取り込み）
+        for table, column, decl in (("detections", "source_id", "INTEGER"), ("imports", "cursor", "TEXT")):
+            columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        self.conn.commit()
+        self.replaced_rows = 0  # import_csv で取り込み直すために消した行数
+
+    def append_rows(self, rows):
+        """(timestamp, name) をまとめて1トランザクションで追加する"""
+        with self.conn:
+            self.conn.executemany("INSERT INTO detections (timestamp, name) VALUES (?, ?)", rows)
+
+    def iter_rows(self, start=None, end=None):
+        """start 以上 end 未満の (timestamp, name) を時刻順に返す"""
+        query = "SELECT timestamp, name FROM detections"
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(end)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp, id"
+        yield from self.conn.execute(query, params)
+
+    def read_since(self, cursor=None, start=None):
+        """cursor（前回読んだ最後の id）より後に追加された行を読む。(rows, 新しい cursor, reset) を返す
+
+        最後の id より前の行が消えていれば（最新行の削除など）先頭から読み直し、reset=True を返す。
+        先頭から読むときに start があれば、start 以上の行だけを読む。
+        """
+        rows, cursor, reset = self._query_since(cursor, start)
+        return rows.fetchall(), cursor, reset
+
+    def _query_since(self, cursor, start=None):
+        """read_since の本体。(行を返す sqlite3 のカーソル, 新しい cursor, reset) を返す"""
+        last_id = cursor["id"] if cursor else 0
+        max_id = self.conn.execute("SELECT MAX(id) FROM detections").fetchone()[0] or 0
+        reset = cursor is None or max_id < last_id
+        if reset and start is not None:
+            rows = self.conn.execute(
+                "SELECT timestamp, name FROM detections WHERE timestamp >= ? AND id <= ? ORDER BY id",
+                (start, max_id))
+            return rows, {"id": max_id}, reset
+        if reset:
+            last_id = 0
+        rows = self.conn.execute(
+            "SELECT timestamp, name FROM detections WHERE id > ? AND id <= ? ORDER BY id",
+            (last_id, max_id))
+        return rows, {"id": max_id}, reset
+
+    def read_columns_since(self, cursor=None, batch_size=100000):
+        """read_since と同じ範囲を LogColumns（NumPy の列）で返す。batch_size 行ずつ読んで列に変換する"""
+        rows, cursor, reset = self._query_since(cursor)
+        batches = iter(lambda: rows.fetchmany(batch_size), [])
+        return LogColumns.from_row_batches(batches), cursor, reset
+
+    def relabel(self, timestamp, old_name, new_name):
+        return self.relabel_many(timestamp, [(old_name, new_name)])
+
+    def relabel_many(self, timestamp, changes):
+        """指定時刻の行の名前を changes（[(old_name, new_name)]）でまとめて変える（1トランザクション）"""
+        mapping = _relabel_mapping(changes)
+        with self.conn:
+            # 名前の入れ替えで2回変わらないよう、変える前の名前で行を決めてから id で更新する
+            updates = [(mapping[name], row_id) for row_id, name in self.conn.execute(
+                "SELECT id, name FROM detections WHERE timestamp = ?", (timestamp,)) if name in mapping]
+            self.conn.executemany("UPDATE detections SET name = ? WHERE id = ?", updates)
+        return len(updates)
+
+    def delete(self, timestamp):
+        with self.conn:
+            cur = self.conn.execute("DELETE FROM detections WHERE timestamp = ?", (timestamp,))
+        return cur.rowcount
+
+    def import_csv(self, path, force=False, batch_size=10000):
+        """CSV（.csv.gz も可）を取り込む。取り込んだ行数を返す（取り込み済みで飛ばしたときは None）
+
+        取り込んだ行には取り込み元（imports の rowid）を source_id として付ける。
+        .csv.gz は一度取り込んだら force なしでは飛ばす。
+        .csv（現在のログ）は前回取り込んだ位置から追記された行だけを取り込み、
+        書き直されていたら（rotate_logs.py など）前回の分を消して取り込み直す。
+        force なら前回の分を消して先頭から取り込み直す。消すのと取り込むのは1トランザクションで行う。
+        """
+        source = os.path.abspath(path)
+        compressed = path.endswith(".gz")
+        previous = self.conn.execute("SELECT rowid, cursor FROM imports WHERE source = ?", (source,)).fetchone()
+        if previous and compressed and not force:
+            return None
+        cursor = None
+        if previous and previous[1] is not None and not force and not compressed:
+            cursor = json.loads(previous[1])
+            cursor["tail"] = bytes.fromhex(cursor["tail"])
+
+        count = 0
+        with self.conn:
+            if compressed:
+                f = gzip.open(path, "rb")
+                limit = None
+                new_cursor = None
+                reset = True
+            else:
+                f = open(path, "rb")
+                offset, end, new_cursor, reset = CsvLogStore(path)._range_since(f, cursor)
+                if cursor is not None and reset:
+                    print(f"ログが書き直されているため取り込み直します: {path}")
+                f.seek(offset)
+                limit = end - offset
+                new_cursor["tail"] = new_cursor["tail"].hex()
+            with f:
+                if previous and reset:
+                    self.replaced_rows += self._delete_import(previous[0], path, legacy=previous[1] is None)
+                    self.conn.execute("UPDATE imports SET rows = 0 WHERE rowid = ?", (previous[0],))
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO imports (source, rows, imported_at) VALUES (?, 0, ?)",
+                    (source, time.time()))
+                source_id = self.conn.execute("SELECT rowid FROM imports WHERE source = ?", (source,)).fetchone()[0]
+
+                batch = []
+                for block in iter_line_blocks(f, limit=limit):
+                    for row in csv.reader(io.StringIO(block.decode("utf-8", errors="replace"))):
+                        # ヘッダ行と壊れた行は timestamp の長さで除く
+                        if len(row) < 2 or len(row[0]) != 19:
+                            continue
+                        batch.append((row[0], row[1], source_id))
+                        if len(batch) >= batch_size:
+                            count += self._insert_imported(batch)
+                            batch = []
+                count += self._insert_imported(batch)
+            # .csv.gz は取り込み済みの印として空の cursor を残す
+            self.conn.execute(
+                "UPDATE imports SET rows = rows + ?, imported_at = ?, cursor = ? WHERE rowid = ?",
+                (count, time.time(), json.dumps(new_cursor or {}), source_id))
+        return count
+
+    def _insert_imported(self, rows):
+        self.conn.executemany("INSERT INTO detections (timestamp, name, source_id) VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def _delete_import(self, source_id, path, legacy=False):
+        """以前に path から取り込んだ行を消す。消した行数を返す"""
+        deleted = self.conn.execute("DELETE FROM detections WHERE source_id = ?", (source_id,)).rowcount
+        if not legacy:
+            return deleted
+        # source_id を記録する前の取り込みは、ファイルにある時刻の範囲で消す（トラッカーが書いた行は残す）
+        first = last = None
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", newline="", encoding="utf-8", errors="replace") as f:
+            for row in csv.reader(f):
+                if len(row) >= 2 and len(row[0]) == 19:
+                    first = row[0] if first is None else min(first, row[0])
+                    last = row[0] if last is None else max(last, row[0])
+        if first is not None:
+            deleted += self.conn.execute(
+                "DELETE FROM detections WHERE source_id IS NULL AND timestamp >= ? AND timestamp <= ?",
+                (first, last)).rowcount
+        return deleted
+
+    def close(self):
+        self.conn.close()
+
+def import_all(config, force=False):
+    """アーカイブ（古い月から順）と現在の CSV を SQLite に取り込む"""
+    db_path = os.path.expanduser(config.get("log_db_path", "~/tv_watch_log.db"))
+    store = SqliteLogStore(db_path)
+    sources = sorted(glob.glob(os.path.join(ARCHIVE_DIR, "tv_watch_log_*.csv.gz")))
+    log_path = os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
+    if os.path.exists(log_path):
+        sources.append(log_path)
+
+    total = 0
+    for path in sources:
+        count = store.import_csv(path, force=force)
+        if count is None:
+            print(f"取り込み済みのためスキップ: {path}")
+        else:
+            print(f"取り込み: {path} ({count} 件)")
+            total += count
+    replaced = store.replaced_rows
+    store.close()
+    print(f"取り込み完了: {total} 件 -> {db_path}")
+    if replaced and config.get("log_backend", "csv") == "sqlite":
+        # 取り込み直しで消した行が分単位の集計に残らないよう、次の表示で集計し直させる
+        from rollup_store import open_rollup_store
+        rollup = open_rollup_store(config)
+        rollup.invalidate()
+        rollup.close()
+    if config.get("log_backend", "csv") != "sqlite":
+        print('config.json の "log_backend" を "sqlite" にすると SQLite を使用します')
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "import":
+        import_all(load_config(), force="--force" in sys.argv[2:])
+    else:
+        print("使い方: python log_store.py import [--force]")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+視聴時間の分単位の集計（ロールアップ）
+
+視聴ログを人物・日・分ごとの「視聴秒数」と「検出回数」にまとめて SQLite に保存する。
+管理画面の日別・時間帯別・期間推移は、ログの行ではなくこの集計を足し合わせて返す。
+
+視聴秒数の数え方は従来どおり:
+  同じ人物の同じ日の前回検出から gap_threshold_sec 以内なら、その間隔を今回の検出の分に計上する
+
+ログは log_columns の NumPy の列として読み、視聴秒数の計算と分ごとの集計をまとめて行う。
+集計は前回読み終えたログの位置（log_store の read_since の cursor）と一緒に
+1トランザクションで更新するので、途中で落ちても二重に数えない。
+ログが作り直された・書き直されたときは、読み直した最初の日以降を集計し直す
+（rotate_logs.py でアーカイブした月の集計はそのまま残る）。
+
+作り直す:
+    python rollup_store.py rebuild
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import sqlite3
+from datetime import datetime
+
+from log_columns import LogColumns, iter_line_blocks
+from log_store import ARCHIVE_DIR, load_config, open_log_store
+
+DEFAULT_PATH = "~/tv_watch_rollup.db"
+VERSION = 2  # state の形式が変わったら上げる（作り直しになる）
+FOLD_ROWS = 500000  # 視聴秒数と分ごとの集計を一度に計算する行数（作業用の配列のメモリを抑える）
+
+def open_rollup_store(config):
+    """設定の rollup_path の集計を開く"""
+    return RollupStore(os.path.expanduser(config.get("rollup_path", DEFAULT_PATH)))
+
+def _source_key(config):
+    """集計の元になるログの識別子（変わったら作り直す）"""
+    if config.get("log_backend", "csv") == "sqlite":
+        return "sqlite:" + os.path.expanduser(config.get("log_db_path", "~/tv_watch_log.db"))
+    return "csv:" + os.path.expanduser(config.get("log_path", "~/tv_watch_log.csv"))
+
+def _iter_archive_columns():
+    """rotate_logs.py のアーカイブを古い月から順に読む"""
+    for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, "tv_watch_log_*.csv.gz"))):
+        with gzip.open(path, "rb") as f:
+            yield LogColumns.from_csv_blocks(iter_line_blocks(f))
+
+class RollupStore:
+    """人物・日・分ごとの視聴秒数と検出回数
+
+    minutes テーブル: (day "YYYY-MM-DD", minute 0-1439, name) -> seconds, detections
+    state テーブル:   ログの読み込み位置、人物ごとの最後の検出時刻（epoch 秒）、gap_threshold_sec など
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # トランザクションは sync() で明示的に張る
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS minutes (
+                day TEXT NOT NULL,
+                minute INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                seconds REAL NOT NULL DEFAULT 0,
+                detections INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, minute, name)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+
+    def _get_state(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_state(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _fold(self, columns, last_seen, gap_threshold_sec):
+        """columns（LogColumns）を集計に足し込む。last_seen（{name: epoch}）は更新される。件数を返す"""
+        # 区切り目の前回検出は last_seen で引き継ぎ、同じ分が2回出ても足し込まれる
+        for part in columns.split(FOLD_ROWS):
+            seconds = part.watch_seconds(gap_threshold_sec, last_seen)
+            self.conn.executemany("""
+                INSERT INTO minutes (day, minute, name, seconds, detections) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (day, minute, name) DO UPDATE SET
+                    seconds = seconds + excluded.seconds,
+                    detections = detections + excluded.detections
+            """, part.minute_totals(seconds))
+        return len(columns)
+
+    def sync(self, config):
+        """ログに追記された行を集計に足し込む。足し込んだ行数を返す"""
+        gap_threshold_sec = config.get("gap_threshold_sec", 120)
+        source = _source_key(config)
+        store = open_log_store(config)
+        try:
+            # 読み込み位置の取得から更新までを1トランザクションにして、同時に呼ばれても二重に数えない
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._get_cursor()
+                rebuild = (self._get_state("version") != VERSION
+                           or self._get_state("source") != source
+                           or self._get_state("gap_threshold_sec") != gap_threshold_sec)
+                if rebuild:
+                    cursor = None
+                    self.conn.execute("DELETE FROM minutes")
+                last_seen = {} if rebuild else self._get_state("last_seen", {})
+
+                columns, new_cursor, reset = store.read_columns_since(cursor)
+                count = 0
+                if rebuild and store.backend == "csv":
+                    # 作り直しではアーカイブ済みの月も集計する
+                    for archive in _iter_archive_columns():
+                        count += self._fold(archive, last_seen, gap_threshold_sec)
+                elif reset and len(columns):
+                    # ローテーション・書き直し: 読み直した最初の日以降を集計し直す
+                    first_day = columns.day_string(0)
+                    self.conn.execute("DELETE FROM minutes WHERE day >= ?", (first_day,))
+                    first_day_start = int(columns.epoch[0]) // 86400 * 86400
+                    last_seen = {name: ts for name, ts in last_seen.items() if ts < first_day_start}
+                count += self._fold(columns, last_seen, gap_threshold_sec)
+
+                self._set_state("cursor", {k: v.hex() if isinstance(v, bytes) else v
+                                           for k, v in new_cursor.items()} if new_cursor else None)
+                self._set_state("last_seen", last_seen)
+                self._set_state("source", source)
+                self._set_state("gap_threshold_sec", gap_threshold_sec)
+                self._set_state("version", VERSION)
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        finally:
+            store.close()
+        return count
+
+    def _get_cursor(self):
+        cursor = self._get_state("cursor")
+        if cursor and "tail" in cursor:
+            cursor["tail"] = bytes.fromhex(cursor["tail"])
+        return cursor
+
+    def invalidate(self):
+        """ログの既存行を書き換えたときに呼ぶ。次の sync() でログにある最初の日以降を集計し直す"""
+        self._set_state("cursor", None)
+
+    def daily(self, start_day, end_day, since=None):
+        """start_day〜end_day（両端含む）の {日: {人物: 視聴分}}。since（datetime）より前の分は除く"""
+        query = "SELECT day, name, SUM(seconds) FROM minutes WHERE day >= ? AND day <= ?"
+        params = [start_day, end_day]
+        if since is not None:
+            query += " AND (day > ? OR (day = ? AND minute >= ?))"
+            since_day = since.strftime("%Y-%m-%d")
+            params += [since_day, since_day, since.hour * 60 + since.minute]
+        query += " GROUP BY day, name HAVING SUM(seconds) > 0"
+        result = {}
+        for day, name, seconds in self.conn.execute(query, params):
+            result.setdefault(day, {})[name] = seconds / 60.0
+        return result
+
+    def hourly(self, day):
+        """指定日の {時 "HH": {人物: 視聴分}}"""
+        result = {}
+        for hour, name, seconds in self.conn.execute("""
+                SELECT minute / 60, name, SUM(seconds) FROM minutes
+                WHERE day = ? GROUP BY minute / 60, name HAVING SUM(seconds) > 0
+                """, (day,)):
+            result.setdefault(f"{hour:02d}", {})[name] = seconds / 60.0
+        return result
+
+    def detected_minutes(self, start, end):
+        """start（datetime）以上 end 以下の分のうち、検出があった {人物: [分の開始時刻]}"""
+        result = {}
+        for day, minute, name in self.conn.execute("""
+                SELECT day, minute, name FROM minutes
+                WHERE detections > 0 AND day >= ? AND day <= ?
+                ORDER BY day, minute
+                """, (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))):
+            ts = datetime.strptime(day, "%Y-%m-%d").replace(hour=minute // 60, minute=minute % 60)
+            if start.replace(second=0, microsecond=0) <= ts <= end:
+                result.setdefault(name, []).append(ts)
+        return result
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "rebuild":
+        config = load_config()
+        store = open_rollup_store(config)
+        store.conn.execute("DELETE FROM state")
+        count = store.sync(config)
+        store.close()
+        print(f"集計を作り直しました: {count} 件 -> {store.path}")
+    else:
+        print("使い方: python rollup_store.py rebuild")
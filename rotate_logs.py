@@ -14,6 +14,7 @@ import shutil
 import json
 import datetime as dt
 from collections import defaultdict
+from log_store import index_path, write_index
 
 # 設定ファイル読み込み
 CONFIG_PATH = os.path.expanduser("~/config.json")
@@ -31,6 +32,11 @@ def load_config():
 
 def rotate_log():
     config = load_config()
+    if config.get("log_backend", "csv") == "sqlite":
+        # SQLite は期間指定でインデックスを引くので、ファイルを分割する必要がない
+        print("log_backend が sqlite のためローテーションは不要です")
+        return
+
     log_path = os.path.expanduser(config["log_path"])
 
     if not os.path.exists(log_path):
@@ -98,6 +104,10 @@ def rotate_log():
         writer.writerow(header)
         writer.writerows(current_rows)
 
+    # バイト位置が変わるので索引（トラッカーが作る .idx）を作り直す
+    if os.path.exists(index_path(log_path)):
+        write_index(log_path)
+
     print(f"ログローテーション完了: {archived_count} 件アーカイブ, {len(current_rows)} 件残存")
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import os
+import sys
 import csv
 import json
 import datetime as dt
 from collections import defaultdict
+from log_store import open_log_store
 
 # 設定ファイル読み込み
 CONFIG_PATH = os.path.expanduser("~/config.json")
@@ -28,20 +30,29 @@ OUT_PATH = os.path.expanduser("~/tv_watch_summary.csv")
 INTERVAL_SEC = config["interval_sec"]
 TARGET_NAMES = config["target_names"]
 
+# 集計期間（省略時は全期間）: python summarize_tv.py [開始日 [終了日]]（YYYY-MM-DD、終了日を含む）
+# CSV ログは索引（.idx）で開始日の位置まで飛んで読む
+START = END = None
+if len(sys.argv) > 1:
+    START = dt.datetime.strptime(sys.argv[1], "%Y-%m-%d").strftime("%Y-%m-%d %H:%M:%S")
+if len(sys.argv) > 2:
+    END = (dt.datetime.strptime(sys.argv[2], "%Y-%m-%d") + dt.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+
 # 日付×名前で分数を集計
 minutes = defaultdict(float)
 
-with open(LOG_PATH, newline="", encoding="utf-8") as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        name = row["name"]
+store = open_log_store(config)
+try:
+    for timestamp, name in store.iter_rows(start=START, end=END):
         if name not in TARGET_NAMES:
             continue  # unknown / none は無視
 
-        ts = dt.datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S")
+        ts = dt.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
         date_str = ts.date().isoformat()
         key = (date_str, name)
         minutes[key] += INTERVAL_SEC / 60.0
+finally:
+    store.close()
 
 with open(OUT_PATH, "w", newline="", encoding="utf-8") as f:
     writer = csv.writer(f)
@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
+import io
 import os
 import sys
 import time
 import csv
 import json
+import queue
+import select
+import signal
+import socket
 import logging
+import threading
+import subprocess
 import datetime as dt
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 import cv2
 import face_recognition
+import numpy as np
 import pickle
 
+from log_store import open_log_store, read_index, append_index, write_index, check_index_entry
+from frame_channel import FrameChannelWriter, default_path as frame_channel_path
+from camera_broker import CameraSource, BrokerSource
+
 # ロギング設定
 logging.basicConfig(
     level=logging.INFO,
@@ -37,9 +51,50 @@ def load_config():
         "log_path": "~/tv_watch_log.csv",
         "camera_retry_sec": 5,
         "max_camera_retries": 10,
+        "camera_source": "device",  # "device" またはカメラブローカー経由の "broker"
+        "camera_channel_path": "/dev/shm/tv_watch_camera",
         "save_detections": True,
         "detections_dir": "~/detections",
         "max_detection_images": 100,
+        "max_detection_bytes": None,  # 検出画像の合計サイズの上限（バイト）
+        "max_detection_age_days": None,  # これより古い検出画像を削除する
+        "motion_gate": True,
+        "motion_width": 160,
+        "motion_threshold": 25,
+        "motion_min_ratio": 0.01,
+        "motion_max_skip_sec": 60,
+        "tracker": True,
+        "tracker_iou": 0.3,
+        "tracker_stable_iou": 0.6,
+        "tracker_reverify_frames": 10,
+        "tracker_min_margin": 0.05,
+        "tracker_max_missed": 2,
+        "persist_queue_size": 8,
+        "persist_drop_policy": "block",  # 画像・メタデータの保存だけに効く（ログの行は捨てない）
+        "min_interval_sec": None,  # 未指定なら interval_sec
+        "max_interval_sec": None,  # 未指定なら interval_sec（適応なし）
+        "backoff_after_empty": 6,
+        "gap_threshold_sec": 120,  # 視聴中断とみなす間隔（ダッシュボードと共通）
+        # face_model: "cascade" 用（候補検出 -> 候補周辺のみCNN）
+        "cascade_prefilter": "haar",  # "haar" または "hog"
+        "cascade_padding": 0.5,  # 候補の大きさに対する余白の割合
+        "cascade_prefilter_width": 320,  # hog 候補検出時の縮小幅
+        "encodings_poll_sec": 5,  # encodings.pkl の更新確認間隔
+        "control_socket": "~/.tv_watch_tracker.sock",  # 空文字ならSIGHUPのみ
+        "log_flush_rows": 12,  # この行数たまったらログを書き出す
+        "log_flush_sec": 60,  # 前回の書き出しからこの秒数経ったら書き出す
+        "log_durability": "flush",  # "flush" または "fsync"
+        "log_backend": "csv",  # "csv" または "sqlite"
+        "log_db_path": "~/tv_watch_log.db",  # log_backend が sqlite のときの保存先
+        "encode_full_res": False,  # True: 縮小画像で検出し、縮小前の切り出しでエンコード
+        "detect_width": 320,  # encode_full_res 時の検出用の縮小幅
+        "frame_channel_path": "/dev/shm/tv_watch_latest_frame",  # 最新フレームの共有メモリ（空文字で無効）
+        "metrics_path": "~/tv_watch_metrics.json",  # 処理時間・リソースの書き出し先
+        "metrics_interval_sec": 10,
+        "metrics_window": 300,  # パーセンタイルを計算する直近のサンプル数
+        "memory_budget_mb": None,  # RSSの上限（MB）。超えそうなら検出設定を軽くする（Noneで無効）
+        "memory_headroom": 0.8,  # 上限のこの割合を下回る状態が続いたら設定を戻す
+        "memory_recover_frames": 30,  # 設定を1段戻すまでに余裕が続くフレーム数
     }
     if os.path.exists(CONFIG_PATH):
         try:
@@ -54,349 +109,1936 @@ def load_config():
         logger.info("設定ファイルなし。デフォルト設定を使用: %s", CONFIG_PATH)
     return defaults
 
+def read_encodings(path):
+    """顔エンコーディングを読み込んで検証する。不正な場合は ValueError"""
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+
+    if "names" not in data or "encodings" not in data:
+        raise ValueError("エンコーディングファイルの形式が不正です")
+
+    names = data["names"]
+    encodings = data["encodings"]
+    if len(names) == 0:
+        raise ValueError("登録された顔がありません")
+    if len(names) != len(encodings):
+        raise ValueError("名前とエンコーディングの数が一致しません")
+    if any(np.shape(enc) != np.shape(encodings[0]) for enc in encodings):
+        raise ValueError("エンコーディングの次元が揃っていません")
+
+    return names, encodings
+
 def load_encodings(path):
-    """顔エンコーディングを読み込む"""
+    """顔エンコーディングを読み込む（起動時用。失敗したら終了）"""
     if not os.path.exists(path):
         logger.error("エンコーディングファイルが見つかりません: %s", path)
         logger.error("先に build_encodings.py を実行してください")
         sys.exit(1)
 
     try:
-        with open(path, "rb") as f:
-            data = pickle.load(f)
+        return read_encodings(path)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(1)
+    except Exception as e:
+        logger.error("エンコーディングファイルの読み込みエラー: %s", e)
+        sys.exit(1)
 
-        if "names" not in data or "encodings" not in data:
-            logger.error("エンコーディングファイルの形式が不正です")
-            sys.exit(1)
+class FaceMatcher:
+    """登録済みエンコーディングを1つの行列にまとめ、フレーム内の全顔を一括で照合する
 
-        if len(data["names"]) == 0:
-            logger.error("登録された顔がありません")
-            sys.exit(1)
+    compare_faces と face_distance を顔ごとに呼ぶ代わりに、
+    (顔数 x 登録数) の距離行列を1回の行列演算で求める。
+    """
 
-        return data["names"], data["encodings"]
+    def __init__(self, names, encodings):
+        # 同じラベルの行が連続するよう並べ替え（ラベル別最小距離を reduceat で求めるため）
+        order = sorted(range(len(names)), key=lambda i: names[i])
+        self.names = [names[i] for i in order]
+        gallery = np.asarray([encodings[i] for i in order], dtype=np.float32)
+        self.gallery = np.ascontiguousarray(gallery.reshape(len(order), -1))
+        self.gallery_sq = np.einsum("ij,ij->i", self.gallery, self.gallery)
 
-    except Exception as e:
-        logger.error("エンコーディングファイルの読み込みエラー: %s", e)
-        sys.exit(1)
+        self.labels = []
+        starts = []
+        for i, name in enumerate(self.names):
+            if not self.labels or self.labels[-1] != name:
+                self.labels.append(name)
+                starts.append(i)
+        self.label_starts = np.asarray(starts, dtype=np.intp)
 
-def open_camera(device, retry_sec, max_retries):
-    """カメラを開く。失敗時はリトライ"""
-    for attempt in range(max_retries):
-        cap = cv2.VideoCapture(device)
-        if cap.isOpened():
-            logger.info("カメラを開きました: device=%s", device)
-            return cap
-
-        logger.warning(
-            "カメラを開けません (試行 %d/%d)。%d秒後にリトライ...",
-            attempt + 1, max_retries, retry_sec
-        )
-        time.sleep(retry_sec)
+    def __len__(self):
+        return len(self.names)
 
-    logger.error("カメラを開けませんでした。終了します。")
-    sys.exit(1)
+    def distances(self, encodings):
+        """全顔 x 全登録エンコーディングのユークリッド距離行列を返す"""
+        probes = np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1)
+        probes_sq = np.einsum("ij,ij->i", probes, probes)
+        # |a-b|^2 = |a|^2 + |b|^2 - 2a.b
+        d2 = probes @ self.gallery.T
+        d2 *= -2.0
+        d2 += probes_sq[:, None]
+        d2 += self.gallery_sq[None, :]
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2, out=d2)
 
-def ensure_log_file(path):
-    """ログファイルが存在しなければ作成"""
-    if not os.path.exists(path):
+    def match(self, encodings, tolerance):
+        """各顔の照合結果を返す
+
+        戻り値は顔ごとの辞書のリスト:
+          name            一致したラベル（閾値を超えたら "unknown"）
+          distance        最良一致の距離
+          label_distances ラベルごとの最小距離
+          margin          2番目に近いラベルとの距離差（ラベルが1つならNone）
+        """
+        if len(encodings) == 0 or len(self.names) == 0:
+            return []
+
+        dist = self.distances(encodings)
+        label_min = np.minimum.reduceat(dist, self.label_starts, axis=1)
+
+        results = []
+        for row in label_min:
+            if len(self.labels) > 1:
+                best, runner_up = np.argpartition(row, 1)[:2]
+                margin = float(row[runner_up] - row[best])
+            else:
+                best = 0
+                margin = None
+            best_distance = float(row[best])
+            results.append({
+                "name": self.labels[best] if best_distance <= tolerance else "unknown",
+                "distance": best_distance,
+                "label_distances": dict(zip(self.labels, row.tolist())),
+                "margin": margin,
+            })
+        return results
+
+class GalleryWatcher:
+    """encodings.pkl の更新を mtime で検知し、バックグラウンドで読み込んで差し替える
+
+    poll() は推論ループから毎フレーム呼ばれるが、stat は poll_sec ごとにしか行わない。
+    新しいギャラリーは別スレッドで読み込み・検証し、次の poll() で FaceMatcher として返す。
+    読み込みに失敗した場合は現在のギャラリーを使い続ける。
+    """
+
+    def __init__(self, path, poll_sec=5):
+        self.path = path
+        self.poll_sec = poll_sec
+        self._signature = self._stat()
+        self._failed_signature = None
+        self._last_poll = time.monotonic()
+        self._lock = threading.Lock()
+        self._pending = None
+        self._loading = False
+        self.reloads = 0
+        self.last_reload_ms = None
+
+    def _stat(self):
         try:
-            with open(path, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(["timestamp", "name"])
-            logger.info("ログファイルを作成しました: %s", path)
-        except IOError as e:
-            logger.error("ログファイルを作成できません: %s", e)
-            sys.exit(1)
-
-def write_log(path, timestamp, names):
-    """ログに書き込む"""
-    try:
-        with open(path, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            if names:
-                for name in sorted(names):
-                    writer.writerow([timestamp, name])
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def poll(self):
+        """読み込み済みの新しい FaceMatcher があれば返す（なければNone）"""
+        now = time.monotonic()
+        if now - self._last_poll >= self.poll_sec:
+            self._last_poll = now
+            signature = self._stat()
+            if (signature is not None and signature != self._signature
+                    and signature != self._failed_signature and not self._loading):
+                self._loading = True
+                threading.Thread(target=self._load, args=(signature,),
+                                 name="gallery", daemon=True).start()
+
+        with self._lock:
+            matcher, self._pending = self._pending, None
+        return matcher
+
+    def _load(self, signature):
+        start = time.monotonic()
+        try:
+            names, encodings = read_encodings(self.path)
+            matcher = FaceMatcher(names, encodings)
+        except Exception as e:
+            logger.warning("エンコーディングの再読み込みに失敗（現在のギャラリーを継続）: %s", e)
+            self._failed_signature = signature
+            self._loading = False
+            return
+
+        self.last_reload_ms = round((time.monotonic() - start) * 1000, 1)
+        self.reloads += 1
+        with self._lock:
+            self._pending = matcher
+            self._signature = signature
+        self._loading = False
+        logger.info("エンコーディングを再読み込みしました: %d件, 人物: %s (%.0fms)",
+                    len(matcher), matcher.labels, self.last_reload_ms)
+
+    def stats(self):
+        return {"reloads": self.reloads, "last_reload_ms": self.last_reload_ms}
+
+class MotionGate:
+    """縮小グレースケール画像で変化を判定し、静止中は顔検出をスキップさせる
+
+    背景は移動平均で更新するため、座ったまま動かない人物は数フレームで
+    背景に取り込まれ、以降のフレームは「変化なし」と判定される。
+    max_skip_sec を超えてスキップが続いた場合は強制的に検出を行う。
+    """
+
+    def __init__(self, width=160, threshold=25, min_ratio=0.01, max_skip_sec=60, alpha=0.5):
+        self.width = width
+        self.threshold = threshold
+        self.min_ratio = min_ratio
+        self.max_skip_sec = max_skip_sec
+        self.alpha = alpha
+        self.background = None
+        self.last_detect_time = 0.0
+        self.frames = 0
+        self.skipped = 0
+
+    def _prepare(self, frame):
+        h, w = frame.shape[:2]
+        if w > self.width:
+            frame = cv2.resize(frame, (self.width, max(1, int(h * self.width / w))),
+                               interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def should_detect(self, frame):
+        """検出が必要ならTrue、前回の結果を再利用してよければFalse"""
+        gray = self._prepare(frame)
+        now = time.monotonic()
+        self.frames += 1
+
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray.astype(np.float32)
+            self.last_detect_time = now
+            return True
+
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        changed_ratio = np.count_nonzero(diff > self.threshold) / diff.size
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+
+        if changed_ratio >= self.min_ratio or now - self.last_detect_time >= self.max_skip_sec:
+            self.last_detect_time = now
+            return True
+
+        self.skipped += 1
+        return False
+
+    def force_next(self):
+        """次のフレームを変化の有無にかかわらず検出させる"""
+        self.last_detect_time = float("-inf")
+
+    def stats(self):
+        return {"frames": self.frames, "skipped": self.skipped}
+
+def box_iou(a, b):
+    """(top, right, bottom, left) 形式の2つの矩形のIoU"""
+    top = max(a[0], b[0])
+    right = min(a[1], b[1])
+    bottom = min(a[2], b[2])
+    left = max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    if inter == 0:
+        return 0.0
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter)
+
+class FaceTracker:
+    """フレーム間で顔をIoUで対応付け、安定したトラックは再エンコードせず名前を引き継ぐ
+
+    以下の場合のみエンコーディング（と照合）が必要と判定する:
+      - 新しいトラック
+      - 位置が大きく動いた（IoU が stable_iou 未満）
+      - 前回の照合が曖昧（unknown、または2位との差が min_margin 未満）
+      - 最後のエンコードから reverify_frames フレーム経過
+    """
+
+    def __init__(self, iou_threshold=0.3, stable_iou=0.6, reverify_frames=10,
+                 min_margin=0.05, max_missed=2):
+        self.iou_threshold = iou_threshold
+        self.stable_iou = stable_iou
+        self.reverify_frames = reverify_frames
+        self.min_margin = min_margin
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 1
+        self.encoded = 0
+        self.reused = 0
+
+    def update(self, locations):
+        """検出位置をトラックに対応付け、位置ごとのトラックを返す"""
+        pairs = []
+        for ti, track in enumerate(self.tracks):
+            for li, loc in enumerate(locations):
+                iou = box_iou(track["bbox"], loc)
+                if iou >= self.iou_threshold:
+                    pairs.append((iou, ti, li))
+        pairs.sort(reverse=True)
+
+        assigned = [None] * len(locations)
+        used_tracks = set()
+        for iou, ti, li in pairs:
+            if ti in used_tracks or assigned[li] is not None:
+                continue
+            track = self.tracks[ti]
+            track["stable"] = iou >= self.stable_iou
+            track["bbox"] = locations[li]
+            track["missed"] = 0
+            track["frames_since_encode"] += 1
+            assigned[li] = track
+            used_tracks.add(ti)
+
+        survivors = []
+        for ti, track in enumerate(self.tracks):
+            if ti in used_tracks:
+                survivors.append(track)
             else:
-                writer.writerow([timestamp, "none"])
-    except IOError as e:
-        logger.error("ログ書き込みエラー: %s", e)
+                track["missed"] += 1
+                if track["missed"] <= self.max_missed:
+                    survivors.append(track)
 
-def main():
-    # 設定読み込み
-    config = load_config()
+        for li, loc in enumerate(locations):
+            if assigned[li] is None:
+                track = {
+                    "id": self.next_id,
+                    "bbox": loc,
+                    "name": None,
+                    "distance": 1.0,
+                    "margin": None,
+                    "stable": False,
+                    "missed": 0,
+                    "frames_since_encode": 0,
+                }
+                self.next_id += 1
+                survivors.append(track)
+                assigned[li] = track
 
-    CAMERA_DEVICE = config["camera_device"]
-    ENC_PATH = os.path.expanduser(config["encodings_path"])
-    LOG_PATH = os.path.expanduser(config["log_path"])
-    INTERVAL_SEC = config["interval_sec"]
-    TOLERANCE = config["tolerance"]
-    FACE_MODEL = config["face_model"]
-    UPSAMPLE = config["upsample"]
-    RESIZE_WIDTH = config.get("resize_width", 640)
-
-    # ROI設定：roi_indexとroi_presetsから適用するROIを決定
-    ROI = config.get("roi")
+        self.tracks = survivors
+        return assigned
+
+    def needs_encoding(self, track):
+        if track["name"] is None or track["name"] == "unknown" or not track["stable"]:
+            return True
+        if track["margin"] is not None and track["margin"] < self.min_margin:
+            return True
+        return track["frames_since_encode"] >= self.reverify_frames
+
+    def set_identity(self, track, match):
+        track["name"] = match["name"]
+        track["distance"] = match["distance"]
+        track["margin"] = match["margin"]
+        track["frames_since_encode"] = 0
+
+    def reset(self):
+        """全トラックの名前を破棄して次回に再照合させる"""
+        for track in self.tracks:
+            track["name"] = None
+
+    def stats(self):
+        return {"tracks": len(self.tracks), "encoded": self.encoded, "reused": self.reused}
+
+def scale_box(box, factor, shape):
+    """(top, right, bottom, left) を factor 倍し、画像サイズ内に収める"""
+    h, w = shape[:2]
+    top, right, bottom, left = box
+    return (max(0, int(round(top * factor))), min(w, int(round(right * factor))),
+            min(h, int(round(bottom * factor))), max(0, int(round(left * factor))))
+
+def merge_regions(regions):
+    """重なり合う (x1, y1, x2, y2) 矩形を外接矩形にまとめる"""
+    merged = []
+    for region in sorted(regions):
+        x1, y1, x2, y2 = region
+        i = 0
+        while i < len(merged):
+            mx1, my1, mx2, my2 = merged[i]
+            if x1 < mx2 and mx1 < x2 and y1 < my2 and my1 < y2:
+                x1, y1, x2, y2 = min(x1, mx1), min(y1, my1), max(x2, mx2), max(y2, my2)
+                merged.pop(i)
+                i = 0
+            else:
+                i += 1
+        merged.append((x1, y1, x2, y2))
+    return merged
+
+class CascadeDetector:
+    """安価な検出器で候補領域を出し、その周辺の切り出しだけを CNN で検出する
+
+    CNN を ROI 全体にかけるとメモリと時間がかかりすぎるため、
+    OpenCV 付属の Haar カスケード（または低解像度の HOG）で候補を探し、
+    余白付きの切り出し画像に対してのみ CNN を実行する。
+    """
+
+    def __init__(self, prefilter="haar", padding=0.5, prefilter_width=320):
+        self.padding = padding
+        self.prefilter_width = prefilter_width
+        self.haar = None
+        if prefilter == "haar":
+            try:
+                path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+                haar = cv2.CascadeClassifier(path)
+                if not haar.empty():
+                    self.haar = haar
+            except (AttributeError, cv2.error) as e:
+                logger.warning("Haarカスケードを読み込めません: %s", e)
+            if self.haar is None:
+                logger.warning("Haarカスケードが使えないため低解像度HOGで候補検出します")
+        self.prefilter = "haar" if self.haar is not None else "hog"
+        self.candidates = 0
+
+    def _proposals(self, rgb):
+        """候補領域を (x1, y1, x2, y2) のリストで返す"""
+        if self.haar is not None:
+            gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+            found = self.haar.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3, minSize=(20, 20))
+            return [(int(x), int(y), int(x + w), int(y + h)) for (x, y, w, h) in found]
+
+        h, w = rgb.shape[:2]
+        scale = 1.0
+        small = rgb
+        if w > self.prefilter_width:
+            scale = self.prefilter_width / w
+            small = cv2.resize(rgb, (self.prefilter_width, max(1, int(h * scale))))
+        locations = face_recognition.face_locations(small, model="hog", number_of_times_to_upsample=1)
+        return [(int(left / scale), int(top / scale), int(right / scale), int(bottom / scale))
+                for (top, right, bottom, left) in locations]
+
+    def detect(self, rgb, upsample):
+        """(top, right, bottom, left) 形式の顔位置を返す"""
+        h, w = rgb.shape[:2]
+        regions = []
+        for (x1, y1, x2, y2) in self._proposals(rgb):
+            pad = int(max(x2 - x1, y2 - y1) * self.padding)
+            regions.append((max(0, x1 - pad), max(0, y1 - pad), min(w, x2 + pad), min(h, y2 + pad)))
+        self.candidates += len(regions)
+
+        locations = []
+        for (x1, y1, x2, y2) in merge_regions(regions):
+            crop = np.ascontiguousarray(rgb[y1:y2, x1:x2])
+            for (top, right, bottom, left) in face_recognition.face_locations(
+                    crop, model="cnn", number_of_times_to_upsample=upsample):
+                box = (top + y1, right + x1, bottom + y1, left + x1)
+                if all(box_iou(box, other) < 0.5 for other in locations):
+                    locations.append(box)
+        return locations
+
+def resolve_roi(config):
+    """roi_index と roi_presets から適用するROIを決定する（ROI無効ならNone）"""
+    roi = config.get("roi")
     roi_index = config.get("roi_index", "")
     roi_presets = config.get("roi_presets", [])
     if roi_index and roi_presets:
         try:
             idx = int(roi_index) - 1  # 1-based to 0-based
             if 0 <= idx < len(roi_presets):
-                ROI = roi_presets[idx]
-                logger.info("ROIプリセット %s を適用: %s", roi_index, ROI.get("name", ""))
+                roi = roi_presets[idx]
+                logger.info("ROIプリセット %s を適用: %s", roi_index, roi.get("name", ""))
         except (ValueError, IndexError) as e:
             logger.warning("ROIプリセットの適用に失敗: %s", e)
 
-    USE_ROI = config.get("use_roi", True)
-    CAMERA_RETRY_SEC = config["camera_retry_sec"]
-    MAX_CAMERA_RETRIES = config["max_camera_retries"]
-    SAVE_DETECTIONS = config.get("save_detections", True)
-    DETECTIONS_DIR = os.path.expanduser(config.get("detections_dir", "~/detections"))
-    MAX_DETECTION_IMAGES = config.get("max_detection_images", 100)
+    if not config.get("use_roi", True) or not roi:
+        return None
+    return roi
 
-    # 検出画像保存ディレクトリ作成
-    if SAVE_DETECTIONS:
-        os.makedirs(DETECTIONS_DIR, exist_ok=True)
+class StageTimer:
+    """処理段階ごとの所要時間（ms）を直近 window 件だけ保持し、p50/p95/p99 を出す
 
-    # 適用中の設定を保存（管理画面で参照用）
-    applied_config = {
-        "face_model": FACE_MODEL,
-        "upsample": UPSAMPLE,
-        "interval_sec": INTERVAL_SEC,
-        "tolerance": TOLERANCE,
-        "roi_index": config.get("roi_index", "")
+    推論スレッドと保存スレッドの両方から記録される。
+    """
+
+    def __init__(self, window=300):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._counts = {}
+
+    def record(self, stage, elapsed_ms):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+                self._counts[stage] = 0
+            samples.append(elapsed_ms)
+            self._counts[stage] += 1
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.monotonic() - started) * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            items = [(stage, np.array(samples), self._counts[stage])
+                     for stage, samples in self._samples.items() if samples]
+        result = {}
+        for stage, samples, count in items:
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            result[stage] = {
+                "count": count,
+                "p50": round(float(p50), 2),
+                "p95": round(float(p95), 2),
+                "p99": round(float(p99), 2),
+                "max": round(float(samples.max()), 2),
+            }
+        return result
+
+# vcgencmd get_throttled のビット
+THROTTLED_FLAGS = {
+    0: "under_voltage",
+    1: "freq_capped",
+    2: "throttled",
+    3: "soft_temp_limit",
+    16: "under_voltage_occurred",
+    17: "freq_capped_occurred",
+    18: "throttled_occurred",
+    19: "soft_temp_limit_occurred",
+}
+
+def read_rss_mb():
+    """(現在のRSS, ピークRSS) をMBで返す（取得できなければ None）"""
+    rss = peak = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return rss, peak
+
+# reset_peak_rss() で戻す前のピークRSSの最大値（メトリクスの rss_peak_mb はプロセス起動からの最大）
+cleared_peak_mb = None
+
+def reset_peak_rss():
+    """ピークRSS（VmHWM）を現在値に戻す。できなければ False
+
+    戻す前の値は cleared_peak_mb に残し、read_system_stats() の最大値に含める。
+    """
+    global cleared_peak_mb
+    _, peak = read_rss_mb()
+    if peak is not None and (cleared_peak_mb is None or peak > cleared_peak_mb):
+        cleared_peak_mb = peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def read_system_stats():
+    """RSS（rss_peak_mb はプロセス起動からの最大）・CPU温度・スロットリング状態を返す（取得できない項目は None）"""
+    stats = {"rss_mb": None, "rss_peak_mb": None, "cpu_temp_c": None,
+             "throttled": None, "throttled_flags": []}
+    rss, peak = read_rss_mb()
+    if rss is not None:
+        stats["rss_mb"] = round(rss, 1)
+    if cleared_peak_mb is not None:
+        # MemoryGuard がフレームごとに VmHWM を戻しているので、戻す前の最大値と合わせる
+        peak = cleared_peak_mb if peak is None else max(peak, cleared_peak_mb)
+    if peak is not None:
+        stats["rss_peak_mb"] = round(peak, 1)
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp") as f:
+            stats["cpu_temp_c"] = round(int(f.read().strip()) / 1000, 1)
+    except (OSError, ValueError):
+        pass
+    try:
+        out = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=2).stdout
+        value = int(out.strip().split("=")[1], 16)
+        stats["throttled"] = hex(value)
+        stats["throttled_flags"] = [name for bit, name in THROTTLED_FLAGS.items() if value & (1 << bit)]
+    except (OSError, ValueError, IndexError, subprocess.SubprocessError):
+        pass
+    return stats
+
+class MemoryGuard:
+    """RSS の上限（budget_mb）を超えないよう、検出設定を段階的に軽くする
+
+    推論の前に「ROI面積 × 縮小 × upsample」から必要メモリを見積もり、
+    上限を超えそうなとき、または前フレームのピークRSSが上限を超えたときに1段下げる。
+      CNN（cascade 含む）-> HOG -> upsample を1ずつ下げる -> resize_width を下げる
+    見積もりと実測に余裕（headroom）がある状態が recover_frames 回続いたら1段戻す。
+    画素あたりのメモリ量はモデルごとに初期値から始め、実測のピークで補正する。
+    """
+
+    # 検出する画素1つあたりのメモリ（バイト）の初期値
+    BYTES_PER_PX = {"cnn": 1000.0, "cascade": 250.0, "hog": 60.0}
+    RESIZE_STEPS = (480, 320)
+    MAX_TRANSITIONS = 20
+
+    def __init__(self, budget_mb, headroom=0.8, recover_frames=30):
+        self.budget_mb = float(budget_mb)
+        self.headroom = headroom
+        self.recover_frames = recover_frames
+        self.bytes_per_px = dict(self.BYTES_PER_PX)
+        self.can_reset_peak = reset_peak_rss()
+        self.levels = []
+        self.level = 0
+        self.transitions = []
+        self.last_peak_mb = None
+        self.last_estimate_mb = None
+        self._rss_before = None
+        self._pixels = None
+        self._headroom_frames = 0
+
+    def configure(self, config):
+        """設定から段階（0 が設定どおり）を作り直し、段階0に戻す"""
+        # encode_full_res では検出に detect_width を使うので、そちらを下げる
+        self.width_key = "detect_width" if config.get("encode_full_res", False) else "resize_width"
+        model = config.get("face_model", "hog")
+        upsample = int(config.get("upsample", 0))
+        width = config.get(self.width_key, 640) or 0
+        levels = [{"face_model": model, "upsample": upsample, self.width_key: width}]
+        if model in ("cnn", "cascade"):
+            model = "hog"
+            levels.append({"face_model": model, "upsample": upsample, self.width_key: width})
+        while upsample > 0:
+            upsample -= 1
+            levels.append({"face_model": model, "upsample": upsample, self.width_key: width})
+        for step in self.RESIZE_STEPS:
+            if width == 0 or step < width:
+                width = step
+                levels.append({"face_model": model, "upsample": upsample, self.width_key: width})
+        self.levels = levels
+        self.level = 0
+        self._headroom_frames = 0
+
+    def settings(self):
+        return self.levels[self.level]
+
+    def _pixels_for(self, settings, frame_shape, roi):
+        h, w = frame_shape[:2]
+        if roi:
+            h, w = min(h, roi["h"]), min(w, roi["w"])
+        width = settings[self.width_key]
+        if width and w > width:
+            h, w = h * width / w, width
+        return h * w * 4 ** settings["upsample"]
+
+    def _estimate_mb(self, settings, frame_shape, roi, rss_mb):
+        pixels = self._pixels_for(settings, frame_shape, roi)
+        return rss_mb + pixels * self.bytes_per_px[settings["face_model"]] / (1024 * 1024)
+
+    def _move(self, level, reason, rss_mb):
+        transition = {
+            "at": time.time(),
+            "from": dict(self.levels[self.level]),
+            "to": dict(self.levels[level]),
+            "reason": reason,
+            "rss_mb": round(rss_mb, 1),
+            "peak_mb": round(self.last_peak_mb, 1) if self.last_peak_mb is not None else None,
+            "estimate_mb": round(self.last_estimate_mb, 1) if self.last_estimate_mb is not None else None,
+        }
+        self.transitions = (self.transitions + [transition])[-self.MAX_TRANSITIONS:]
+        logger.warning("メモリ制限 %.0fMB: %s -> %s (%s)", self.budget_mb,
+                       transition["from"], transition["to"], reason)
+        self.level = level
+        self._headroom_frames = 0
+
+    def before(self, frame_shape, roi):
+        """推論の前に呼ぶ。段階を変えたら新しい設定を、変えなければ None を返す"""
+        rss_mb, _ = read_rss_mb()
+        if rss_mb is None:
+            return None
+        start_level = self.level
+
+        # 前フレームのピークが上限を超えていたら1段下げる
+        if self.last_peak_mb is not None and self.last_peak_mb > self.budget_mb \
+                and self.level < len(self.levels) - 1:
+            self._move(self.level + 1, "peak", rss_mb)
+            self.last_peak_mb = None
+
+        # 見積もりが上限を超えるあいだ下げる
+        estimate = self._estimate_mb(self.settings(), frame_shape, roi, rss_mb)
+        while estimate > self.budget_mb and self.level < len(self.levels) - 1:
+            self.last_estimate_mb = estimate
+            self._move(self.level + 1, "estimate", rss_mb)
+            estimate = self._estimate_mb(self.settings(), frame_shape, roi, rss_mb)
+        self.last_estimate_mb = estimate
+
+        # 1段上でも余裕があれば、一定フレーム続いたところで戻す
+        if self.level == start_level and self.level > 0:
+            limit = self.budget_mb * self.headroom
+            upper = self._estimate_mb(self.levels[self.level - 1], frame_shape, roi, rss_mb)
+            peak_ok = self.last_peak_mb is None or self.last_peak_mb < limit
+            if upper < limit and peak_ok:
+                self._headroom_frames += 1
+                if self._headroom_frames >= self.recover_frames:
+                    self._move(self.level - 1, "headroom", rss_mb)
+            else:
+                self._headroom_frames = 0
+
+        self._rss_before = rss_mb
+        self._pixels = self._pixels_for(self.settings(), frame_shape, roi)
+        if self.can_reset_peak:
+            reset_peak_rss()
+        return self.settings() if self.level != start_level else None
+
+    def after(self, detected=True):
+        """推論の後に呼ぶ。このフレームのピークRSSを記録し、見積もりを補正する"""
+        rss_mb, peak_mb = read_rss_mb()
+        if not self.can_reset_peak:
+            peak_mb = rss_mb
+        self.last_peak_mb = peak_mb
+        if not detected or peak_mb is None or self._rss_before is None or not self._pixels:
+            return
+        used = (peak_mb - self._rss_before) * 1024 * 1024
+        if used > 0:
+            model = self.settings()["face_model"]
+            observed = used / self._pixels
+            self.bytes_per_px[model] = 0.8 * self.bytes_per_px[model] + 0.2 * observed
+
+    def stats(self):
+        return {
+            "budget_mb": self.budget_mb,
+            "level": self.level,
+            "settings": self.settings() if self.levels else None,
+            "peak_mb": round(self.last_peak_mb, 1) if self.last_peak_mb is not None else None,
+            "estimate_mb": round(self.last_estimate_mb, 1) if self.last_estimate_mb is not None else None,
+            "transitions": self.transitions,
+        }
+
+class FrameAnalyzer:
+    """推論ステージ: ROI切り出し・縮小・検出・エンコード・照合を1フレーム分行う"""
+
+    def __init__(self, config, matcher, timer=None):
+        self.matcher = matcher
+        self.timer = timer or StageTimer()
+        self.configure(config)
+
+        # 動き検出ゲート（静止中は前回の検出結果を再利用）
+        self.motion_gate = None
+        if config.get("motion_gate", True):
+            self.motion_gate = MotionGate(
+                width=config.get("motion_width", 160),
+                threshold=config.get("motion_threshold", 25),
+                min_ratio=config.get("motion_min_ratio", 0.01),
+                max_skip_sec=config.get("motion_max_skip_sec", 60),
+            )
+
+        # フレーム間トラッカー（安定した顔は再エンコードしない）
+        self.face_tracker = None
+        if config.get("tracker", True):
+            self.face_tracker = FaceTracker(
+                iou_threshold=config.get("tracker_iou", 0.3),
+                stable_iou=config.get("tracker_stable_iou", 0.6),
+                reverify_frames=config.get("tracker_reverify_frames", 10),
+                min_margin=config.get("tracker_min_margin", 0.05),
+                max_missed=config.get("tracker_max_missed", 2),
+            )
+
+        self.last_face_results = []
+        self.last_seen_names = set()
+
+    def configure(self, config):
+        self.face_model = config["face_model"]
+        self.upsample = config["upsample"]
+        self.tolerance = config["tolerance"]
+        self.resize_width = config.get("resize_width", 640)
+        self.encode_full_res = config.get("encode_full_res", False)
+        self.detect_width = config.get("detect_width", 320)
+        self.roi = resolve_roi(config)
+        self.cascade = None
+        if self.face_model == "cascade":
+            self.cascade = CascadeDetector(
+                prefilter=config.get("cascade_prefilter", "haar"),
+                padding=config.get("cascade_padding", 0.5),
+                prefilter_width=config.get("cascade_prefilter_width", 320),
+            )
+
+    def reconfigure(self, config):
+        """稼働中に検出設定を変更する（フレーム間でのみ呼ぶこと）"""
+        self.configure(config)
+        # ROI・縮小幅・閾値が変わるとトラックの座標や名前が無効になるため照合し直す
+        if self.face_tracker is not None:
+            self.face_tracker.tracks = []
+        if self.motion_gate is not None:
+            self.motion_gate.force_next()
+
+    def set_matcher(self, matcher):
+        """ギャラリーを差し替える（フレーム間でのみ呼ぶこと）"""
+        self.matcher = matcher
+        if self.face_tracker is not None:
+            self.face_tracker.reset()
+        # 前回結果の名前は古いギャラリー基準なので次フレームで必ず検出し直す
+        if self.motion_gate is not None:
+            self.motion_gate.force_next()
+
+    def detect(self, rgb):
+        """設定されたモデルで顔位置を検出する"""
+        if self.cascade is not None:
+            return self.cascade.detect(rgb, self.upsample)
+        return face_recognition.face_locations(
+            rgb,
+            model=self.face_model,
+            number_of_times_to_upsample=self.upsample,
+        )
+
+    def encode_crops(self, bgr, locations, padding=0.25):
+        """縮小前の画像から顔ごとに余白付きで切り出し、切り出し画像上でエンコードする"""
+        h, w = bgr.shape[:2]
+        encodings = []
+        for (top, right, bottom, left) in locations:
+            pad = int((bottom - top) * padding)
+            y1, x1 = max(0, top - pad), max(0, left - pad)
+            y2, x2 = min(h, bottom + pad), min(w, right + pad)
+            crop = cv2.cvtColor(bgr[y1:y2, x1:x2], cv2.COLOR_BGR2RGB)
+            encodings.extend(face_recognition.face_encodings(
+                crop, [(top - y1, right - x1, bottom - y1, left - x1)]))
+        return encodings
+
+    def analyze(self, frame):
+        """1フレームを処理し、ROI情報・顔（フルフレーム座標）・検出名を返す"""
+        roi = self.roi
+
+        # ROI適用（ピクセル値）
+        roi_info = None  # メタデータ保存用
+        roi_offset_x = 0
+        roi_offset_y = 0
+        if roi:
+            roi_info = {"x": roi["x"], "y": roi["y"], "w": roi["w"], "h": roi["h"]}
+            x1 = roi["x"]
+            y1 = roi["y"]
+            x2 = x1 + roi["w"]
+            y2 = y1 + roi["h"]
+            roi_offset_x = x1
+            roi_offset_y = y1
+            frame = frame[y1:y2, x1:x2]
+
+        motion_gate = self.motion_gate
+        face_tracker = self.face_tracker
+        timer = self.timer
+        detected = True
+        if motion_gate is not None:
+            with timer.measure("motion_gate"):
+                detected = motion_gate.should_detect(frame)
+
+        if detected:
+            # 縮小処理（メモリ節約）。full-res エンコード時は検出用に detect_width まで縮小する
+            width = self.detect_width if self.encode_full_res else self.resize_width
+            detect_frame = frame
+            scale = 1.0
+            if width and width > 0:
+                h, w = frame.shape[:2]
+                if w > width:
+                    scale = width / w
+                    with timer.measure("resize"):
+                        detect_frame = cv2.resize(frame, (width, int(h * scale)))
+
+            # BGR -> RGB 変換
+            with timer.measure("cvt_color"):
+                rgb = cv2.cvtColor(detect_frame, cv2.COLOR_BGR2RGB)
+
+            # 顔検出（縮小画像上の座標）
+            with timer.measure("face_locations"):
+                detect_locations = self.detect(rgb)
+
+            # ROI 座標（縮小前）に戻す
+            face_locations = [scale_box(loc, 1.0 / scale, frame.shape) for loc in detect_locations]
+
+            def encode(indices):
+                indices = list(indices)
+                if not indices:
+                    return []
+                with timer.measure("face_encodings"):
+                    if self.encode_full_res:
+                        # 縮小前のROIから顔の周辺だけを切り出してエンコード
+                        return self.encode_crops(frame, [face_locations[i] for i in indices])
+                    return face_recognition.face_encodings(rgb, [detect_locations[i] for i in indices])
+
+            def match(face_encodings):
+                if not face_encodings:
+                    return []
+                with timer.measure("match"):
+                    return self.matcher.match(face_encodings, self.tolerance)
+
+            seen_names = set()
+            face_results = []  # [(name, location, distance), ...]
+
+            if face_tracker is not None:
+                # トラックに対応付け、必要な顔だけエンコード・照合
+                with timer.measure("tracker"):
+                    tracks = face_tracker.update(face_locations)
+                pending = [i for i, t in enumerate(tracks) if face_tracker.needs_encoding(t)]
+                face_encodings = encode(pending)
+                for i, m in zip(pending, match(face_encodings)):
+                    face_tracker.set_identity(tracks[i], m)
+                face_tracker.encoded += len(pending)
+                face_tracker.reused += len(tracks) - len(pending)
+
+                for location, track in zip(face_locations, tracks):
+                    if track["name"] is None:
+                        continue
+                    seen_names.add(track["name"])
+                    face_results.append((track["name"], location, track["distance"]))
+            else:
+                # 顔エンコーディング
+                face_encodings = encode(range(len(face_locations)))
+
+                # 全顔を一括照合
+                for location, m in zip(face_locations, match(face_encodings)):
+                    seen_names.add(m["name"])
+                    face_results.append((m["name"], location, m["distance"]))
+
+            self.last_face_results = face_results
+            self.last_seen_names = seen_names
+        else:
+            # 変化なし：前回の検出結果をそのまま使う
+            face_results = self.last_face_results
+            seen_names = set(self.last_seen_names)
+            logger.debug("変化なし: 検出をスキップ (%d/%d)",
+                         motion_gate.skipped, motion_gate.frames)
+
+        # 座標をフルフレーム基準に変換
+        faces = []
+        for name, (top, right, bottom, left), dist in face_results:
+            faces.append({
+                "name": name,
+                "bbox": {
+                    "top": top + roi_offset_y,
+                    "right": right + roi_offset_x,
+                    "bottom": bottom + roi_offset_y,
+                    "left": left + roi_offset_x
+                },
+                "distance": dist,
+                "similarity": max(0, (1 - dist) * 100)
+            })
+
+        return {"roi": roi_info, "faces": faces, "names": seen_names, "detected": detected}
+
+    def stats(self):
+        return {
+            "cascade_candidates": self.cascade.candidates if self.cascade else None,
+            "motion_gate": self.motion_gate.stats() if self.motion_gate else None,
+            "tracker": self.face_tracker.stats() if self.face_tracker else None,
+        }
+
+class StageQueue:
+    """パイプラインのステージ間をつなぐ有界キュー
+
+    満杯時の扱いは drop_policy で選ぶ:
+      block        空きが出るまで待つ
+      drop_oldest  最も古い要素を捨てて追加する
+      drop_newest  追加しようとした要素を捨てる
+    """
+
+    DROP_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, name, maxsize, drop_policy="drop_oldest"):
+        if drop_policy not in self.DROP_POLICIES:
+            logger.warning("不明なdrop_policy: %s（drop_oldestを使用）", drop_policy)
+            drop_policy = "drop_oldest"
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.drop_policy = drop_policy
+        self.queue = queue.Queue(maxsize=self.maxsize)
+        self.dropped = 0
+
+    def put(self, item, force=False):
+        """要素を追加する。捨てた場合はFalse（force=Trueなら常に待って追加）"""
+        if force or self.drop_policy == "block":
+            self.queue.put(item)
+            return True
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                if self.drop_policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def stats(self):
+        return {"depth": self.queue.qsize(), "maxsize": self.maxsize, "dropped": self.dropped}
+
+class LogWriter:
+    """tv_watch_log.csv を開いたまま保持し、行をバッファしてまとめて書き出す
+
+    行は推論ループが write() でバッファに足し（保存キューで結果が捨てられてもログは残る）、
+    保存ステージが flush_rows 行たまるか前回の書き出しから flush_sec 秒経つと書き出す
+    （結果が来なくても next_flush_in() の秒数で flush_if_due() を呼ぶ）。
+    書き出しに失敗した行はバッファに戻し、次の書き出しでやり直す（max_buffer_rows を超えた古い行は捨てる）。
+    durability:
+      "flush"  OS のページキャッシュまで書き出す（電源断で直近分は失われうる）
+      "fsync"  書き出しのたびに fsync して SD カードまで確実に書き込む
+    起動時には、クラッシュで途中まで書かれた最終行を切り詰めてから追記を始める。
+    CSV では、時間が変わった最初の行のバイト位置を索引（tv_watch_log.csv.idx）に追記する。
+    """
+
+    def __init__(self, path, flush_rows=12, flush_sec=60, durability="flush", store=None,
+                 max_buffer_rows=100000):
+        self.path = path
+        self.store = store
+        self.flush_rows = max(1, int(flush_rows))
+        self.flush_sec = flush_sec
+        self.max_buffer_rows = max(self.flush_rows, int(max_buffer_rows))
+        self.fsync = durability == "fsync"
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self.bytes_written = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self.flush_ms_total = 0.0
+        self.flush_ms_max = 0.0
+        self.flush_errors = 0
+        self.dropped_rows = 0
+
+        self._file = None
+        self._index_hour = None
+        if store is None:
+            self._recover()
+            self._prepare_index()
+            self._open()
+
+    def _open(self):
+        self._file = open(self.path, "a", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+
+    def _discard_partial(self, size):
+        """書き出しに失敗した追記を捨てて開き直す（size は追記前のファイルサイズ）"""
+        try:
+            # 書き出せなかった内容がファイルオブジェクトに残っていても、閉じれば捨てられる
+            self._file.close()
+        except OSError:
+            pass
+        try:
+            if size is not None:
+                os.truncate(self.path, size)
+        except OSError as e:
+            logger.warning("書きかけのログを切り詰められません: %s", e)
+        self._open()
+
+    def _recover(self):
+        """ヘッダがなければ書き、改行で終わっていない最終行を切り詰める"""
+        with open(self.path, "a+b") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                f.write(b"timestamp,name\r\n")
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # 末尾の途中行を探して切り詰める
+            pos = max(0, size - 4096)
+            f.seek(pos)
+            tail = f.read()
+            cut = tail.rfind(b"\n")
+            if cut < 0 and pos > 0:
+                # 改行のない異常に長い末尾。切り詰めずに行を閉じる（読み込み側で不正行として無視される）
+                f.write(b"\r\n")
+                logger.warning("ログ末尾の書きかけの行を閉じました")
+                return
+            new_size = pos + cut + 1 if cut >= 0 else 0
+            f.truncate(new_size)
+            logger.warning("ログ末尾の書きかけの行を切り詰めました: %d -> %d バイト", size, new_size)
+            if new_size == 0:
+                f.write(b"timestamp,name\r\n")
+
+    def _prepare_index(self):
+        """索引がログの末尾まで合っているか確かめ、合わなければ作り直す"""
+        try:
+            entries = read_index(self.path)
+            with open(self.path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(max(0, size - 4096))
+                lines = f.read().splitlines(keepends=True)
+                last_ts = None
+                for line in reversed(lines[1:] if size > 4096 else lines):
+                    if len(line) > 19 and line[19:20] == b",":
+                        last_ts = line[:19].decode("ascii", errors="replace")
+                        break
+                valid = (entries and check_index_entry(f, *entries[-1])
+                         and (last_ts is None or last_ts[:13] == entries[-1][0]))
+            if not valid:
+                count = write_index(self.path)
+                entries = read_index(self.path)
+                if count:
+                    logger.info("ログの索引を作り直しました: %d 件", count)
+            self._index_hour = entries[-1][0] if entries else None
+        except (OSError, ValueError) as e:
+            logger.warning("ログの索引の確認に失敗: %s", e)
+
+    def _index_entries(self, rows, offset):
+        """rows のうち時間が変わった最初の行の (時間, バイト位置)"""
+        entries = []
+        for i, row in enumerate(rows):
+            hour = row[0][:13]
+            if self._index_hour is not None and hour <= self._index_hour:
+                continue
+            # 時間の変わり目は1時間に1回なので、その都度手前の行のバイト数を数える
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows[:i])
+            entries.append((hour, offset + len(buf.getvalue().encode("utf-8"))))
+            self._index_hour = hour
+        return entries
+
+    def write(self, timestamp, names):
+        """行をバッファに足す（推論ループから呼ぶ。書き出しは保存ステージの flush_if_due で行う）"""
+        with self._lock:
+            if names:
+                for name in sorted(names):
+                    self._buffer.append([timestamp, name])
+            else:
+                self._buffer.append([timestamp, "none"])
+
+    def next_flush_in(self):
+        """バッファに行があれば書き出しまでの秒数（flush_rows 行たまっていれば 0）。なければ None"""
+        with self._lock:
+            if not self._buffer:
+                return None
+            if len(self._buffer) >= self.flush_rows:
+                return 0.0
+            return max(0.0, self.flush_sec - (time.monotonic() - self._last_flush))
+
+    def flush_if_due(self):
+        """flush_rows 行たまったか、前回の書き出しから flush_sec 秒経っていれば書き出す"""
+        delay = self.next_flush_in()
+        if delay is not None and delay <= 0:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return
+            rows, self._buffer = self._buffer, []
+            started = time.monotonic()
+            before = None
+            try:
+                if self.store is not None:
+                    # SQLite などのバックエンドへは1トランザクションでまとめて追加
+                    self.store.append_rows(rows)
+                else:
+                    # rotate_logs.py に切り詰められていても追記位置はファイル末尾になるので、サイズから求める
+                    before = os.fstat(self._file.fileno()).st_size
+                    self._writer.writerows(rows)
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                    self.bytes_written += self._file.tell() - before
+                    entries = self._index_entries(rows, before)
+                    if entries:
+                        try:
+                            append_index(self.path, entries, fsync=self.fsync)
+                        except OSError as e:
+                            logger.warning("ログの索引の書き込みに失敗: %s", e)
+                self.rows_written += len(rows)
+            except Exception as e:
+                logger.error("ログ書き込みエラー（%d 行は次の書き出しでやり直します）: %s", len(rows), e)
+                self.flush_errors += 1
+                if self.store is None:
+                    self._discard_partial(before)
+                # 書き出せなかった行をバッファの先頭に戻す
+                self._buffer[:0] = rows
+                overflow = len(self._buffer) - self.max_buffer_rows
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    self.dropped_rows += overflow
+                    logger.warning("ログのバッファがあふれたので古い %d 行を捨てました", overflow)
+                return
+            elapsed_ms = (time.monotonic() - started) * 1000
+            self.flushes += 1
+            self.flush_ms_total += elapsed_ms
+            self.flush_ms_max = max(self.flush_ms_max, elapsed_ms)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            if self.store is not None:
+                self.store.close()
+
+    def stats(self):
+        return {
+            "bytes_written": self.bytes_written,
+            "rows_written": self.rows_written,
+            "buffered_rows": len(self._buffer),
+            "flushes": self.flushes,
+            "flush_ms_avg": round(self.flush_ms_total / self.flushes, 2) if self.flushes else None,
+            "flush_ms_max": round(self.flush_ms_max, 2),
+            "flush_errors": self.flush_errors,
+            "dropped_rows": self.dropped_rows,
+        }
+
+class DetectionRetention:
+    """検出画像（detection_{YYYYMMDD_HHMMSS}_*）の保持数・合計サイズ・保持期間を管理する
+
+    起動時に一度だけディレクトリを走査し、以降はタイムスタンプ順の一覧をメモリ上に持つ。
+    保存のたびに古い側から消すだけなので、ディレクトリの走査は発生しない。
+    Web UI から削除されたファイルは一覧に残るので、上限を超えたときは消す前に一覧のファイルを
+    stat し直し、なくなったファイルを一覧と合計サイズから外す（余計に古い画像を消さない）。
+    """
+
+    PREFIX = "detection_"
+
+    def __init__(self, directory, max_images=100, max_bytes=None, max_age_days=None):
+        self.directory = directory
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_age = dt.timedelta(days=max_age_days) if max_age_days else None
+        self._entries = OrderedDict()  # timestamp_str -> {filename: bytes}
+        self.total_bytes = 0
+        self.evicted = 0
+        self.vanished = 0  # Web UI などで先に削除されていた検出の数
+        self._scan()
+
+    def _timestamp_of(self, filename):
+        ts = filename[len(self.PREFIX):len(self.PREFIX) + 15]  # YYYYMMDD_HHMMSS
+        if (filename.startswith(self.PREFIX) and len(ts) == 15 and ts[8] == "_"
+                and ts[:8].isdigit() and ts[9:].isdigit()):
+            return ts
+        return None
+
+    def _scan(self):
+        found = {}
+        if os.path.isdir(self.directory):
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    ts = self._timestamp_of(entry.name)
+                    if ts is None:
+                        continue
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        continue
+                    found.setdefault(ts, {})[entry.name] = size
+        for ts in sorted(found):
+            self._entries[ts] = found[ts]
+            self.total_bytes += sum(found[ts].values())
+        self.enforce()
+        logger.info("検出画像: %d 件 (%.1f MB)", len(self._entries), self.total_bytes / 1e6)
+
+    def add(self, timestamp_str, filenames):
+        """保存したファイルを登録し、上限を超えた分を古い順に削除する"""
+        files = self._entries.pop(timestamp_str, {})
+        self.total_bytes -= sum(files.values())
+        for name in filenames:
+            try:
+                files[name] = os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                continue
+        self._entries[timestamp_str] = files
+        self.total_bytes += sum(files.values())
+        self.enforce()
+
+    def _over_limit(self):
+        if self.max_images is not None and len(self._entries) > self.max_images:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        if self.max_age is not None:
+            oldest = next(iter(self._entries))
+            try:
+                saved_at = dt.datetime.strptime(oldest, "%Y%m%d_%H%M%S")
+            except ValueError:
+                return True
+            return dt.datetime.now() - saved_at > self.max_age
+        return False
+
+    def _refresh(self):
+        """一覧のファイルが残っているか確かめ、なくなったものを一覧と合計サイズから外す"""
+        for ts in list(self._entries):
+            files = self._entries[ts]
+            for name in list(files):
+                if not os.path.exists(os.path.join(self.directory, name)):
+                    self.total_bytes -= files.pop(name)
+            if not files:
+                del self._entries[ts]
+                self.vanished += 1
+
+    def enforce(self):
+        if len(self._entries) > 1 and self._over_limit():
+            self._refresh()
+        # 直近の1件は残す（保存した直後のファイルを消さない）
+        while len(self._entries) > 1 and self._over_limit():
+            _, files = self._entries.popitem(last=False)
+            self.total_bytes -= sum(files.values())
+            for name in files:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            "images": len(self._entries),
+            "bytes": self.total_bytes,
+            "evicted": self.evicted,
+            "vanished": self.vanished,
+        }
+
+class FrameWriter:
+    """保存ステージで画像・メタデータを書き出す
+
+    JPEG は1フレームにつき1回だけエンコードし、同じ画像を使うファイルにはそのバイト列を書く。
+    書き込みは一時ファイル（隠しファイル）に書いてから rename するので、
+    Web UI が書きかけのファイルを読むことはない。
+    """
+
+    def __init__(self, directory, timer=None):
+        self.directory = directory
+        self.timer = timer
+        self.files_written = 0
+        self.stale_skipped = 0
+        self.encodes = 0
+        self.encode_ms_total = 0.0
+        self.encode_ms_max = 0.0
+        self.write_ms_total = 0.0
+        self.write_ms_max = 0.0
+
+    def encode(self, image):
+        """JPEG にエンコードしたバイト列を返す"""
+        t0 = time.monotonic()
+        ok, buf = cv2.imencode(".jpg", image)
+        if not ok:
+            raise RuntimeError("JPEGエンコードに失敗しました")
+        elapsed_ms = (time.monotonic() - t0) * 1000
+        if self.timer is not None:
+            self.timer.record("jpeg_encode", elapsed_ms)
+        self.encodes += 1
+        self.encode_ms_total += elapsed_ms
+        self.encode_ms_max = max(self.encode_ms_max, elapsed_ms)
+        return buf.tobytes()
+
+    def write(self, filename, data):
+        """bytes を filename に原子的に書き込む"""
+        t0 = time.monotonic()
+        path = os.path.join(self.directory, filename)
+        tmp_path = os.path.join(self.directory, f".{filename}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        elapsed_ms = (time.monotonic() - t0) * 1000
+        if self.timer is not None:
+            self.timer.record("file_write", elapsed_ms)
+        self.files_written += 1
+        self.write_ms_total += elapsed_ms
+        self.write_ms_max = max(self.write_ms_max, elapsed_ms)
+
+    def write_json(self, filename, obj):
+        self.write(filename, json.dumps(obj).encode("utf-8"))
+
+    def stats(self):
+        return {
+            "files_written": self.files_written,
+            "stale_skipped": self.stale_skipped,
+            "encode_ms_avg": round(self.encode_ms_total / self.encodes, 2) if self.encodes else None,
+            "encode_ms_max": round(self.encode_ms_max, 2),
+            "write_ms_avg": round(self.write_ms_total / self.files_written, 2) if self.files_written else None,
+            "write_ms_max": round(self.write_ms_max, 2),
+        }
+
+def persist_result(result, config, log_writer, retention, writer, channel=None, stale=False, timer=None):
+    """保存ステージの1件分: 最新フレーム・検出画像とメタデータを書き出す
+
+    ログの行は推論ループが log_writer にバッファ済み（ここではメタデータに統計を載せるだけ）。
+
+    channel があれば最新フレームは共有メモリに渡し、latest_frame* は SD カードに書かない。
+    stale=True（後続の結果がすでに待っている）のときは、すぐ上書きされる
+    最新フレームの書き出しを省く。検出画像は常に書く。
+    """
+    save_detections = config.get("save_detections", True)
+
+    ts = result["ts"]
+    full_frame = result["frame"]
+    roi_info = result["roi"]
+    faces = result["faces"]
+    seen_names = result["names"]
+    timer = timer or StageTimer()
+
+    save_detection = bool(seen_names) and save_detections and bool(faces)
+    latest_meta = {
+        "timestamp": ts,
+        "roi": roi_info,
+        "faces": [{"name": f["name"], "bbox": f["bbox"], "similarity": f["similarity"]} for f in faces],
     }
+    latest_meta.update(result["stats"])
+    latest_meta["log_writer"] = log_writer.stats()
+    latest_meta["retention"] = retention.stats()
+    latest_meta["frame_writer"] = writer.stats()
+
+    if stale:
+        writer.stale_skipped += 1
+    elif channel is not None:
+        # 生フレームをそのまま渡す（オーバーレイは Web UI 側で描く）
+        latest_meta["frame_channel"] = channel.stats()
+        with timer.measure("frame_channel"):
+            channel.publish(full_frame, latest_meta, captured_at=result["epoch"])
+
+    clean_jpeg = None
+    if save_detection or (not stale and channel is None):
+        clean_jpeg = writer.encode(full_frame)
+
+    if not stale and channel is None:
+        # 最新フレームを常に保存（フルフレームにROI枠とBBox付き）
+        latest_frame = full_frame.copy()
+        # ROI枠を描画（オレンジ色）
+        if roi_info:
+            cv2.rectangle(latest_frame,
+                          (roi_info["x"], roi_info["y"]),
+                          (roi_info["x"] + roi_info["w"], roi_info["y"] + roi_info["h"]),
+                          (0, 165, 255), 2)
+        # BBox描画（座標はフルフレーム基準）
+        for face in faces:
+            bbox = face["bbox"]
+            color = (0, 255, 0) if face["name"] != "unknown" else (0, 0, 255)
+            cv2.rectangle(latest_frame, (bbox["left"], bbox["top"]), (bbox["right"], bbox["bottom"]), color, 2)
+            cv2.putText(latest_frame, f"{face['name']} ({face['similarity']:.0f}%)", (bbox["left"], bbox["top"] - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        writer.write("latest_frame.jpg", writer.encode(latest_frame))
+
+        # クリーンなフレームも保存（撮影用、オーバーレイなし）
+        writer.write("latest_frame_clean.jpg", clean_jpeg)
+
+        # latest_frame用のメタデータを保存（BBox表示用）
+        writer.write_json("latest_frame_meta.json", latest_meta)
+
+    if seen_names:
+        logger.info("%s -> %s", ts, ", ".join(sorted(seen_names)))
+
+        # 検出画像を保存
+        if save_detection:
+            timestamp_str = result["timestamp_str"]
+
+            # 元画像を保存（フルフレーム、オーバーレイなし。latest_frame_clean と同じバイト列）
+            orig_filename = f"detection_{timestamp_str}_original.jpg"
+            writer.write(orig_filename, clean_jpeg)
+
+            # メタデータを保存（座標はフルフレーム基準）
+            meta = {
+                "timestamp": timestamp_str,
+                "roi": roi_info,
+                "faces": [{"name": f["name"], "bbox": f["bbox"], "distance": f["distance"],
+                           "similarity": f["similarity"]} for f in faces]
+            }
+            meta_filename = f"detection_{timestamp_str}_meta.json"
+            writer.write_json(meta_filename, meta)
+
+            # 古いファイルを削除
+            with timer.measure("retention"):
+                retention.add(timestamp_str, [orig_filename, meta_filename])
+    else:
+        logger.debug("%s -> none", ts)
+
+def build_log_writer(config):
+    """設定の log_backend に書き出す LogWriter を作る（CSV はここでヘッダ・書きかけの行・索引を整える）"""
+    store = None
+    if config.get("log_backend", "csv") != "csv":
+        store = open_log_store(config)
+    return LogWriter(
+        os.path.expanduser(config["log_path"]),
+        flush_rows=config.get("log_flush_rows", 12),
+        flush_sec=config.get("log_flush_sec", 60),
+        durability=config.get("log_durability", "flush"),
+        store=store,
+    )
+
+def persistence_stage(config, in_queue, log_writer, timer=None):
+    """保存ステージ: 推論結果を受け取りSDカードへ書き出す（Noneで終了）"""
+    timer = timer or StageTimer()
+    retention = DetectionRetention(
+        os.path.expanduser(config.get("detections_dir", "~/detections")),
+        max_images=config.get("max_detection_images", 100),
+        max_bytes=config.get("max_detection_bytes"),
+        max_age_days=config.get("max_detection_age_days"),
+    )
+    writer = FrameWriter(os.path.expanduser(config.get("detections_dir", "~/detections")), timer=timer)
+    channel = None
+    channel_path = frame_channel_path(config)
+    if channel_path and os.path.isdir(os.path.dirname(channel_path)):
+        channel = FrameChannelWriter(channel_path)
+        logger.info("最新フレームを共有メモリに書き出します: %s", channel_path)
+    try:
+        while True:
+            try:
+                # 結果が来なくても、バッファした行は flush_rows / flush_sec で書き出す
+                result = in_queue.get(timeout=log_writer.next_flush_in())
+            except queue.Empty:
+                result = False
+            with timer.measure("log_write"):
+                log_writer.flush_if_due()
+            if result is False:
+                continue
+            if result is None:
+                break
+            try:
+                # 次の結果がもう待っていれば、この結果の latest_frame* は書かずに追いつく
+                stale = in_queue.stats()["depth"] > 0
+                with timer.measure("persist"):
+                    persist_result(result, config, log_writer, retention, writer,
+                                   channel=channel, stale=stale, timer=timer)
+            except Exception as e:
+                logger.error("保存処理中にエラー: %s", e)
+    finally:
+        if channel is not None:
+            channel.close()
+        log_writer.close()
+        logger.info("ログを書き出しました: %s", log_writer.stats())
+
+class IntervalScheduler:
+    """在室状況に応じて撮影間隔を調整し、処理時間を差し引いた残りだけ待つ
+
+    顔がある間（または現れた直後）は min_interval で回し、
+    顔のないフレームが backoff_after_empty 回続いたら間隔を倍々に伸ばして
+    max_interval まで下げる。実際の開始間隔の移動平均を実効間隔として記録する。
+    """
+
+    def __init__(self, min_interval, max_interval, backoff_after_empty=6):
+        self.min_interval = float(min_interval)
+        self.max_interval = max(float(max_interval), self.min_interval)
+        self.backoff_after_empty = backoff_after_empty
+        self.interval = self.min_interval
+        self.empty_frames = 0
+        self.effective_interval = None
+        self._started_at = None
+        self._prev_started_at = None
+
+    def begin(self):
+        """反復の開始時刻を記録する"""
+        now = time.monotonic()
+        if self._prev_started_at is not None:
+            period = now - self._prev_started_at
+            if self.effective_interval is None:
+                self.effective_interval = period
+            else:
+                self.effective_interval = 0.8 * self.effective_interval + 0.2 * period
+        self._prev_started_at = now
+        self._started_at = now
+
+    def end(self, faces_present):
+        """反復の終了時に呼び、次の開始までの待ち時間（秒）を返す"""
+        if faces_present:
+            self.empty_frames = 0
+            self.interval = self.min_interval
+        else:
+            self.empty_frames += 1
+            if self.empty_frames >= self.backoff_after_empty:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+        elapsed = time.monotonic() - self._started_at
+        return max(0.0, self.interval - elapsed)
+
+    def stats(self):
+        return {
+            "interval_sec": self.interval,
+            "effective_interval_sec": round(self.effective_interval, 2) if self.effective_interval else None,
+            "sampling_hz": round(1.0 / self.effective_interval, 3) if self.effective_interval else None,
+            "empty_frames": self.empty_frames,
+        }
+
+def build_scheduler(config):
+    """設定から IntervalScheduler を作る（max は視聴中断の閾値未満に抑える）"""
+    min_interval = config.get("min_interval_sec") or config["interval_sec"]
+    max_interval = config.get("max_interval_sec") or min_interval
+    gap_threshold = config.get("gap_threshold_sec", 120)
+    if max_interval >= gap_threshold:
+        logger.warning("max_interval_sec=%s は視聴中断の閾値 %s秒以上のため %s秒に制限します",
+                       max_interval, gap_threshold, gap_threshold - 1)
+        max_interval = gap_threshold - 1
+    return IntervalScheduler(min_interval, max_interval, config.get("backoff_after_empty", 6))
+
+class ControlChannel:
+    """稼働中のトラッカーを再起動せずに操作するための制御チャネル
+
+    Unix ソケットで1行のJSON要求（{"cmd": "reload"} / {"cmd": "status"}）を受け付け、
+    推論ループが次のフレームの前に処理した結果を同じ接続で同期的に返す。
+    SIGHUP を受けた場合も config.json を読み直す（応答なし）。
+
+    シグナルハンドラはロックを取らずにフラグを立てるだけにし、
+    待機中の推論ループは signal.set_wakeup_fd のパイプで起こす。
+    """
+
+    COMMANDS = ("reload", "status")
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._requests = queue.Queue()
+        self._reload_requested = False
+        self._sock = None
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+
+    def start(self):
+        signal.set_wakeup_fd(self._wake_w)
+        signal.signal(signal.SIGHUP, self._on_sighup)
+        if not self.path:
+            return self
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            self._sock.listen(4)
+        except OSError as e:
+            logger.warning("制御ソケットを開けません（SIGHUPのみ有効）: %s", e)
+            self._sock = None
+            return self
+        threading.Thread(target=self._serve, name="control", daemon=True).start()
+        logger.info("制御ソケットを開きました: %s", self.path)
+        return self
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _on_sighup(self, signum, frame):
+        # 推論ループが Queue のロックを持っている最中にも呼ばれるので、フラグだけ立てる
+        self._reload_requested = True
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # パイプが埋まっていれば起こす必要はない
+
+    def _serve(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            with conn:
+                try:
+                    conn.settimeout(self.timeout)
+                    line = conn.makefile("r", encoding="utf-8").readline()
+                    request = json.loads(line or "{}")
+                    cmd = request.get("cmd")
+                    if cmd not in self.COMMANDS:
+                        response = {"success": False, "error": f"unknown command: {cmd}"}
+                    else:
+                        req = {"cmd": cmd, "done": threading.Event(), "response": None}
+                        self._requests.put(req)
+                        self._wake()
+                        if req["done"].wait(self.timeout):
+                            response = req["response"]
+                        else:
+                            response = {"success": False, "error": "timeout"}
+                    conn.sendall((json.dumps(response) + "\n").encode("utf-8"))
+                except (OSError, ValueError) as e:
+                    logger.warning("制御要求の処理に失敗: %s", e)
+
+    def pending(self):
+        """未処理の要求を取り出す"""
+        requests = []
+        if self._reload_requested:
+            self._reload_requested = False
+            requests.append({"cmd": "reload", "done": None})
+        while True:
+            try:
+                requests.append(self._requests.get_nowait())
+            except queue.Empty:
+                return requests
+
+    def reply(self, req, response):
+        if req["done"] is not None:
+            req["response"] = response
+            req["done"].set()
+
+    def wait(self, timeout):
+        """timeout 秒待つ。制御要求・シグナルが来たら早めに戻る"""
+        if self._reload_requested:
+            return
+        select.select([self._wake_r], [], [], max(0, timeout))
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+def build_memory_guard(config):
+    """memory_budget_mb が設定されていれば MemoryGuard を作る"""
+    budget = config.get("memory_budget_mb")
+    if not budget:
+        return None
+    guard = MemoryGuard(budget, headroom=config.get("memory_headroom", 0.8),
+                        recover_frames=config.get("memory_recover_frames", 30))
+    guard.configure(config)
+    return guard
+
+def build_applied_config(config, scheduler, guard=None):
+    """管理画面に表示する「適用中の設定」を作る"""
+    return {
+        "face_model": config["face_model"],
+        "upsample": config["upsample"],
+        "interval_sec": config["interval_sec"],
+        "tolerance": config["tolerance"],
+        "roi_index": config.get("roi_index", ""),
+        "resize_width": config.get("resize_width", 640),
+        "gap_threshold_sec": config.get("gap_threshold_sec", 120),
+        "sampling": scheduler.stats(),
+        "memory_guard": guard.stats() if guard else None,
+        "applied_at": time.time(),
+    }
+
+def save_applied_config(applied):
+    """適用中の設定を保存（管理画面で参照用）"""
     try:
-        import json
         with open(os.path.expanduser("~/tv_watch_applied_config.json"), 'w') as f:
-            json.dump(applied_config, f)
+            json.dump(applied, f)
     except Exception as e:
         logger.warning("適用設定の保存に失敗: %s", e)
 
-    logger.info("検出設定: model=%s, upsample=%d, resize=%d, ROI=%s",
-                FACE_MODEL, UPSAMPLE, RESIZE_WIDTH, "有効" if (USE_ROI and ROI) else "無効")
+def build_metrics(timer, frame_count, pipeline, scheduler, guard=None):
+    """処理段階ごとの所要時間とリソース状況をまとめる（管理画面で参照用）"""
+    return {
+        "updated_at": time.time(),
+        "frames": frame_count,
+        "stages": timer.snapshot(),
+        "system": read_system_stats(),
+        "pipeline": pipeline,
+        "sampling": scheduler.stats(),
+        "memory_guard": guard.stats() if guard else None,
+    }
+
+def save_metrics(path, metrics):
+    """メトリクスを一時ファイル経由で書き出す（管理画面が書きかけを読まないように）"""
+    try:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning("メトリクスの保存に失敗: %s", e)
+
+def handle_sigterm(signum, frame):
+    """systemd からの停止要求を Ctrl+C と同じ終了処理に回す"""
+    raise KeyboardInterrupt
+
+def main():
+    startup_started = time.monotonic()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    # 設定読み込み
+    config = load_config()
+
+    ENC_PATH = os.path.expanduser(config["encodings_path"])
+    SAVE_DETECTIONS = config.get("save_detections", True)
+    DETECTIONS_DIR = os.path.expanduser(config.get("detections_dir", "~/detections"))
+    STATS_LOG_FRAMES = 60  # キュー状況をログ出力する間隔（フレーム数）
+    APPLIED_SAVE_SEC = 60  # 実効サンプリング間隔を適用設定に書き戻す最短間隔
+
+    # 検出画像保存ディレクトリ作成
+    if SAVE_DETECTIONS:
+        os.makedirs(DETECTIONS_DIR, exist_ok=True)
+
+    # 撮影間隔スケジューラ
+    scheduler = build_scheduler(config)
+
+    # メモリ上限（超えそうなら検出設定を段階的に軽くする）
+    guard = build_memory_guard(config)
+
+    # 適用中の設定を保存（管理画面で参照用）
+    applied_config = build_applied_config(config, scheduler, guard)
+    save_applied_config(applied_config)
+    applied_saved_at = time.monotonic()
 
     # 顔エンコーディング読み込み
+    gallery_started = time.monotonic()
     known_names, known_encodings = load_encodings(ENC_PATH)
-    logger.info("登録済み顔数: %d, 人物: %s", len(known_names), sorted(set(known_names)))
+    matcher = FaceMatcher(known_names, known_encodings)
+    logger.info("登録済み顔数: %d, 人物: %s (%.0fms)", len(matcher), matcher.labels,
+                (time.monotonic() - gallery_started) * 1000)
+    gallery = GalleryWatcher(ENC_PATH, config.get("encodings_poll_sec", 5))
 
-    # ログファイル準備
-    ensure_log_file(LOG_PATH)
+    # 処理段階ごとの所要時間（推論・保存の両ステージで記録）
+    timer = StageTimer(window=config.get("metrics_window", 300))
+    metrics_path = os.path.expanduser(config.get("metrics_path", "~/tv_watch_metrics.json"))
+    metrics_saved_at = time.monotonic()
 
-    # カメラ初期化
-    cap = open_camera(CAMERA_DEVICE, CAMERA_RETRY_SEC, MAX_CAMERA_RETRIES)
+    analyzer = FrameAnalyzer(config, matcher, timer=timer)
+    logger.info("検出設定: model=%s, upsample=%d, resize=%d, ROI=%s",
+                analyzer.face_model, analyzer.upsample, analyzer.resize_width,
+                "有効" if analyzer.roi else "無効")
 
-    logger.info("監視を開始します (Ctrl+C で停止)")
+    # ログファイル準備（ヘッダ・書きかけの最終行・索引を整える）
+    try:
+        log_writer = build_log_writer(config)
+    except Exception as e:
+        logger.error("ログファイルを開けません: %s", e)
+        sys.exit(1)
+
+    # 取得ステージ: カメラを専用スレッドで読み続け、最新フレームだけを保持
+    if config.get("camera_source", "device") == "broker":
+        # カメラブローカー経由（Web UI のプレビューと同時に使える）
+        camera = BrokerSource(os.path.expanduser(config["camera_channel_path"])).start()
+    else:
+        camera = CameraSource(
+            config["camera_device"],
+            retry_sec=config["camera_retry_sec"],
+            max_retries=config["max_camera_retries"],
+        ).start()
+
+    # 保存ステージへのキュー（推論 -> 保存）
+    persist_queue = StageQueue("persist", config.get("persist_queue_size", 8),
+                               config.get("persist_drop_policy", "block"))
+    stop_event = threading.Event()
 
-    consecutive_failures = 0
-    max_consecutive_failures = 30
+    persist_thread = threading.Thread(target=persistence_stage, name="persist",
+                                      args=(config, persist_queue, log_writer, timer), daemon=True)
+    persist_thread.start()
 
+    # 制御チャネル（再起動なしの設定反映）
+    control_path = config.get("control_socket", "~/.tv_watch_tracker.sock")
+    control = ControlChannel(os.path.expanduser(control_path) if control_path else None).start()
+
+    logger.info("監視を開始します (Ctrl+C で停止) 起動時間: %.1f秒",
+                time.monotonic() - startup_started)
+
+    frame_count = 0
+    pipeline = None
     try:
-        while True:
-            ret, frame = cap.read()
-
-            if not ret:
-                consecutive_failures += 1
-                logger.warning("フレーム取得失敗 (%d/%d)", consecutive_failures, max_consecutive_failures)
-
-                if consecutive_failures >= max_consecutive_failures:
-                    logger.error("連続失敗が上限に達しました。カメラを再接続します...")
-                    cap.release()
-                    time.sleep(CAMERA_RETRY_SEC)
-                    cap = open_camera(CAMERA_DEVICE, CAMERA_RETRY_SEC, MAX_CAMERA_RETRIES)
-                    consecutive_failures = 0
+        while not stop_event.is_set():
+            # 制御要求を次のフレームの前に処理する
+            for req in control.pending():
+                if req["cmd"] == "reload":
+                    started = time.monotonic()
+                    try:
+                        new_config = load_config()
+                        analyzer.reconfigure(new_config)
+                        scheduler = build_scheduler(new_config)
+                        guard = build_memory_guard(new_config)
+                        config = new_config
+                        applied_config = build_applied_config(config, scheduler, guard)
+                        save_applied_config(applied_config)
+                        applied_saved_at = time.monotonic()
+                        logger.info("設定を反映しました: model=%s, upsample=%d, interval=%s, tolerance=%s, "
+                                    "resize=%s, ROI=%s (%.0fms)",
+                                    analyzer.face_model, analyzer.upsample, config["interval_sec"],
+                                    analyzer.tolerance, analyzer.resize_width,
+                                    "有効" if analyzer.roi else "無効",
+                                    (time.monotonic() - started) * 1000)
+                        control.reply(req, {"success": True, "config": applied_config})
+                    except Exception as e:
+                        logger.error("設定の反映に失敗: %s", e)
+                        control.reply(req, {"success": False, "error": str(e)})
                 else:
-                    time.sleep(1)
+                    control.reply(req, {"success": True, "config": applied_config})
+
+            with timer.measure("capture_wait"):
+                item = camera.read(timeout=1)
+            if item is None:
+                if camera.failed or not camera.is_alive():
+                    logger.error("カメラを開けませんでした。終了します。")
+                    sys.exit(1)
                 continue
+            full_frame, captured_at = item
+            scheduler.begin()
 
-            consecutive_failures = 0
+            # ギャラリーが更新されていればフレーム間で差し替える
+            new_matcher = gallery.poll()
+            if new_matcher is not None:
+                analyzer.set_matcher(new_matcher)
 
+            faces_present = False
             try:
-                # 元フレームを保存（ROI適用前）
-                full_frame = frame.copy()
-
-                # ROI適用（ピクセル値）
-                roi_info = None  # メタデータ保存用
-                roi_offset_x = 0
-                roi_offset_y = 0
-                if USE_ROI and ROI:
-                    roi_info = {"x": ROI["x"], "y": ROI["y"], "w": ROI["w"], "h": ROI["h"]}
-                    x1 = ROI["x"]
-                    y1 = ROI["y"]
-                    x2 = x1 + ROI["w"]
-                    y2 = y1 + ROI["h"]
-                    roi_offset_x = x1
-                    roi_offset_y = y1
-                    frame = frame[y1:y2, x1:x2]
-
-                # 縮小処理（メモリ節約）
-                if RESIZE_WIDTH and RESIZE_WIDTH > 0:
-                    h, w = frame.shape[:2]
-                    if w > RESIZE_WIDTH:
-                        scale = RESIZE_WIDTH / w
-                        frame = cv2.resize(frame, (RESIZE_WIDTH, int(h * scale)))
-
-                # BGR -> RGB 変換
-                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                # 顔検出
-                face_locations = face_recognition.face_locations(
-                    rgb,
-                    model=FACE_MODEL,
-                    number_of_times_to_upsample=UPSAMPLE,
-                )
+                # メモリ上限を超えそうなら、推論の前に検出設定を切り替える
+                if guard is not None:
+                    settings = guard.before(full_frame.shape, analyzer.roi)
+                    if settings is not None:
+                        analyzer.reconfigure(dict(config, **settings))
+                        applied_config = build_applied_config(config, scheduler, guard)
+                        save_applied_config(applied_config)
+                        applied_saved_at = time.monotonic()
 
-                # 顔エンコーディング
-                face_encodings = face_recognition.face_encodings(rgb, face_locations)
-
-                seen_names = set()
-                face_results = []  # [(name, location), ...]
-
-                for i, enc in enumerate(face_encodings):
-                    matches = face_recognition.compare_faces(
-                        known_encodings, enc, tolerance=TOLERANCE
-                    )
-                    face_distances = face_recognition.face_distance(known_encodings, enc)
-
-                    if len(face_distances) == 0:
-                        continue
+                # 元フレーム（ROI適用前）はカメラのスロットと共有しているので書き換えない
+                with timer.measure("analyze"):
+                    result = analyzer.analyze(full_frame)
+                if guard is not None:
+                    guard.after(result["detected"])
+                faces_present = bool(result["faces"])
 
-                    best_index = face_distances.argmin()
-                    best_distance = float(face_distances[best_index])
-                    name = "unknown"
-                    if matches[best_index]:
-                        name = known_names[best_index]
-
-                    seen_names.add(name)
-                    if i < len(face_locations):
-                        face_results.append((name, face_locations[i], best_distance))
-
-                ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                write_log(LOG_PATH, ts, seen_names)
-
-                # 最新フレームを常に保存（フルフレームにROI枠とBBox付き）
-                latest_frame = full_frame.copy()
-                # ROI枠を描画（オレンジ色）
-                if roi_info:
-                    cv2.rectangle(latest_frame,
-                                  (roi_info["x"], roi_info["y"]),
-                                  (roi_info["x"] + roi_info["w"], roi_info["y"] + roi_info["h"]),
-                                  (0, 165, 255), 2)
-                # BBox描画（座標をフルフレーム基準に変換）
-                for name, (top, right, bottom, left), dist in face_results:
-                    color = (0, 255, 0) if name != "unknown" else (0, 0, 255)
-                    similarity = max(0, (1 - dist) * 100)
-                    # ROIオフセットを加算してフルフレーム座標に変換
-                    abs_left = left + roi_offset_x
-                    abs_top = top + roi_offset_y
-                    abs_right = right + roi_offset_x
-                    abs_bottom = bottom + roi_offset_y
-                    cv2.rectangle(latest_frame, (abs_left, abs_top), (abs_right, abs_bottom), color, 2)
-                    cv2.putText(latest_frame, f"{name} ({similarity:.0f}%)", (abs_left, abs_top - 10),
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-                latest_path = os.path.join(DETECTIONS_DIR, "latest_frame.jpg")
-                cv2.imwrite(latest_path, latest_frame)
-
-                # クリーンなフレームも保存（撮影用、オーバーレイなし）
-                clean_path = os.path.join(DETECTIONS_DIR, "latest_frame_clean.jpg")
-                cv2.imwrite(clean_path, full_frame)
-
-                # latest_frame用のメタデータを保存（BBox表示用）
-                import json
-                latest_meta = {
-                    "roi": roi_info,
-                    "faces": []
+                now = dt.datetime.now()
+                ts = now.strftime("%Y-%m-%d %H:%M:%S")
+                # ログの行は保存キューを通さない（キューで結果が捨てられても視聴時間は欠けない）
+                log_writer.write(ts, result["names"])
+                pipeline = {
+                    "capture": camera.stats(),
+                    "persist": persist_queue.stats(),  # dropped は画像・メタデータを書かなかった結果の数
+                    "log": {k: v for k, v in log_writer.stats().items()
+                            if k in ("buffered_rows", "rows_written", "dropped_rows")},
+                    "latency_ms": round((time.monotonic() - captured_at) * 1000, 1),
                 }
-                for name, (top, right, bottom, left), dist in face_results:
-                    latest_meta["faces"].append({
-                        "name": name,
-                        "bbox": {
-                            "top": top + roi_offset_y,
-                            "right": right + roi_offset_x,
-                            "bottom": bottom + roi_offset_y,
-                            "left": left + roi_offset_x
-                        },
-                        "similarity": max(0, (1 - dist) * 100)
-                    })
-                latest_meta_path = os.path.join(DETECTIONS_DIR, "latest_frame_meta.json")
-                with open(latest_meta_path, 'w') as f:
-                    json.dump(latest_meta, f)
-
-                if seen_names:
-                    logger.info("%s -> %s", ts, ", ".join(sorted(seen_names)))
-
-                    # 検出画像を保存
-                    if SAVE_DETECTIONS and face_results:
-                        timestamp_str = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-
-                        # 元画像を保存（フルフレーム、オーバーレイなし）
-                        orig_filename = f"detection_{timestamp_str}_original.jpg"
-                        orig_filepath = os.path.join(DETECTIONS_DIR, orig_filename)
-                        cv2.imwrite(orig_filepath, full_frame)
-
-                        # メタデータを保存（座標はフルフレーム基準）
-                        import json
-                        meta = {
-                            "timestamp": timestamp_str,
-                            "roi": roi_info,
-                            "faces": []
-                        }
-                        for name, (top, right, bottom, left), dist in face_results:
-                            # ROIオフセットを加算してフルフレーム座標に変換
-                            meta["faces"].append({
-                                "name": name,
-                                "bbox": {
-                                    "top": top + roi_offset_y,
-                                    "right": right + roi_offset_x,
-                                    "bottom": bottom + roi_offset_y,
-                                    "left": left + roi_offset_x
-                                },
-                                "distance": dist,
-                                "similarity": max(0, (1 - dist) * 100)
-                            })
-                        meta_filename = f"detection_{timestamp_str}_meta.json"
-                        meta_filepath = os.path.join(DETECTIONS_DIR, meta_filename)
-                        with open(meta_filepath, 'w') as f:
-                            json.dump(meta, f)
-
-                        # 各検出者ごとにファイル名を記録（互換性のため）
-                        for name in seen_names:
-                            if name != "unknown":
-                                filename = f"detection_{timestamp_str}_{name}.jpg"
-                                # シンボリックリンクまたはコピーの代わりにメタファイルを参照
-
-                        # 古いファイルを削除
-                        import glob as glob_module
-                        all_files = sorted(glob_module.glob(os.path.join(DETECTIONS_DIR, "detection_*")))
-                        # original.jpg, meta.json, name.jpg のセットを数える
-                        timestamps = set()
-                        for f in all_files:
-                            base = os.path.basename(f)
-                            if base.startswith("detection_") and "_" in base[10:]:
-                                ts_part = base[10:25]  # YYYYMMDD_HHMMSS
-                                timestamps.add(ts_part)
-                        if len(timestamps) > MAX_DETECTION_IMAGES:
-                            old_timestamps = sorted(timestamps)[:-MAX_DETECTION_IMAGES]
-                            for old_ts in old_timestamps:
-                                for old_file in glob_module.glob(os.path.join(DETECTIONS_DIR, f"detection_{old_ts}*")):
-                                    try:
-                                        os.remove(old_file)
-                                    except:
-                                        pass
-                else:
-                    logger.debug("%s -> none", ts)
+                result.update({
+                    "frame": full_frame,
+                    "ts": ts,
+                    "timestamp_str": now.strftime("%Y%m%d_%H%M%S"),
+                    "epoch": now.timestamp(),
+                    "stats": dict(analyzer.stats(), pipeline=pipeline, sampling=scheduler.stats(),
+                                  gallery=gallery.stats()),
+                })
+                persist_queue.put(result)
+
+                frame_count += 1
+                if frame_count % STATS_LOG_FRAMES == 0:
+                    logger.info("キュー状況: camera=%.1ffps (破棄%d, 鮮度%.0fms), persist=%d/%d (画像破棄%d), "
+                                "log=バッファ%d行 (破棄%d行), 遅延=%.0fms",
+                                pipeline["capture"]["grab_fps"], pipeline["capture"]["dropped"],
+                                pipeline["capture"]["frame_age_ms"] or 0,
+                                pipeline["persist"]["depth"], pipeline["persist"]["maxsize"],
+                                pipeline["persist"]["dropped"], pipeline["log"]["buffered_rows"],
+                                pipeline["log"]["dropped_rows"], pipeline["latency_ms"])
 
             except Exception as e:
                 logger.error("顔認識処理中にエラー: %s", e)
 
-            time.sleep(INTERVAL_SEC)
+            timer.record("frame", (time.monotonic() - captured_at) * 1000)
+            control.wait(scheduler.end(faces_present))
+
+            # 処理時間とリソース状況を管理画面向けに書き出す
+            if time.monotonic() - metrics_saved_at >= config.get("metrics_interval_sec", 10):
+                save_metrics(metrics_path, build_metrics(timer, frame_count, pipeline, scheduler, guard))
+                metrics_saved_at = time.monotonic()
+
+            # 実効サンプリング間隔を管理画面向けに記録（SD書き込みを抑えるため間引く）
+            if time.monotonic() - applied_saved_at >= APPLIED_SAVE_SEC:
+                applied_config["sampling"] = scheduler.stats()
+                applied_config["memory_guard"] = guard.stats() if guard else None
+                save_applied_config(applied_config)
+                applied_saved_at = time.monotonic()
 
     except KeyboardInterrupt:
         logger.info("停止要求を受けました")
 
     finally:
-        cap.release()
-        logger.info("カメラを解放しました。終了します。")
+        stop_event.set()
+        # 未保存の結果を書き出してから終了
+        persist_queue.put(None, force=True)
+        persist_thread.join(timeout=30)
+        camera.stop()
+        control.close()
+        logger.info("終了します。")
 
 if __name__ == "__main__":
     main()